@@ -0,0 +1,159 @@
+'''Fetching the list of every television series from Wikidata
+
+The single queries.ALL_TV_SERIES query often runs into the query
+service's 60 second timeout. So by default ('chunked' mode) this
+instead finds every subclass of 'television series' (Q5398426) and
+pages through the instances of each one with queries.TV_SERIES_OF_CLASS_FMT,
+a few queries at a time. Each completed chunk is checkpointed in
+Redis, so if a fetch fails part of the way through, the next one
+carries on from where it got to.
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import json
+from os import environ
+import re
+
+from cache import (
+    acquire_lock, redis_api, redis_delete, redis_get, redis_hgetall, redis_hset,
+    redis_set, release_lock)
+from episodes import id_from_item_url
+import queries
+from query_backends import query_backend
+
+# 'chunked' or 'single-query':
+ALL_SERIES_FETCH_MODE = environ.get('ALL_SERIES_FETCH_MODE', 'chunked')
+ALL_SERIES_CHUNK_SIZE = int(environ.get('ALL_SERIES_CHUNK_SIZE', '20000'))
+ALL_SERIES_FETCH_CONCURRENCY = int(environ.get('ALL_SERIES_FETCH_CONCURRENCY', '2'))
+
+# Checkpoints are kept this long, so a failed fetch can be resumed by
+# the next day's run:
+CHECKPOINT_EXPIRY = 2 * 24 * 60 * 60
+FETCH_LOCK_TIMEOUT = 2 * 60 * 60
+
+CLASSES_KEY = 'all-series-fetch:classes'
+CHUNKS_KEY = 'all-series-fetch:chunks'
+LOCK_KEY = 'all-series-fetch:lock'
+
+
+class FetchAlreadyRunning(Exception):
+    pass
+
+
+def fetch_running():
+    '''Return whether a chunked fetch of all series is running'''
+    return redis_get(redis_api, LOCK_KEY) is not None
+
+
+def items_with_labels(bindings):
+    return [
+        (id_from_item_url(r['series']['value']), r['seriesLabel']['value'])
+        for r in bindings
+        # Items without an English label get their Q-id as the label:
+        if not re.match(r'^Q\d+$', r['seriesLabel']['value'])
+    ]
+
+
+def sorted_by_label(items_with_labels):
+    return sorted(set(items_with_labels), key=lambda t: (t[1], t[0]))
+
+
+def fetch_all_series_single_query():
+    results = query_backend.run_query(queries.ALL_TV_SERIES)
+    return sorted_by_label(items_with_labels(results['results']['bindings']))
+
+
+def chunk_field(class_item, offset):
+    return '{0} {1}'.format(class_item, offset)
+
+
+def fetch_chunk(class_item, offset):
+    query = queries.TV_SERIES_OF_CLASS_FMT.format(
+        class_item=class_item, limit=ALL_SERIES_CHUNK_SIZE, offset=offset)
+    # Failed requests are retried by the query backend; if they still
+    # fail, the chunks fetched so far are kept for the next attempt:
+    bindings = query_backend.run_query(query)['results']['bindings']
+    chunk = {'n': len(bindings), 'items': items_with_labels(bindings)}
+    redis_hset(redis_api, CHUNKS_KEY, chunk_field(class_item, offset), json.dumps(chunk), CHECKPOINT_EXPIRY)
+    return chunk
+
+
+def get_classes():
+    cached = redis_get(redis_api, CLASSES_KEY)
+    if cached is not None:
+        return json.loads(cached)
+    results = query_backend.run_query(queries.TV_SERIES_CLASSES)
+    classes = sorted(set(
+        id_from_item_url(b['class']['value']) for b in results['results']['bindings']
+    ))
+    redis_set(redis_api, CLASSES_KEY, json.dumps(classes), CHECKPOINT_EXPIRY)
+    return classes
+
+
+def next_offsets(classes, chunks):
+    '''Find where to carry on paging through each class from, given completed chunks
+
+    Returns a list of (class_item, offset) tuples for every class that
+    isn't finished yet.'''
+    result = []
+    for class_item in classes:
+        offset = 0
+        while True:
+            chunk = chunks.get(chunk_field(class_item, offset))
+            if chunk is None:
+                result.append((class_item, offset))
+                break
+            if chunk['n'] < ALL_SERIES_CHUNK_SIZE:
+                break
+            offset += ALL_SERIES_CHUNK_SIZE
+    return result
+
+
+def fetch_all_series_chunked(log=None):
+    log = log or (lambda message: None)
+    token = acquire_lock(redis_api, LOCK_KEY, FETCH_LOCK_TIMEOUT)
+    if token is None:
+        raise FetchAlreadyRunning('Another fetch of all series is already running')
+    try:
+        classes = get_classes()
+        chunks = {
+            field.decode('utf-8'): json.loads(value)
+            for field, value in redis_hgetall(redis_api, CHUNKS_KEY).items()
+        }
+        pending = next_offsets(classes, chunks)
+        log('{0} subclasses of television series; resuming with {1} chunks already fetched'.format(
+            len(classes), len(chunks)))
+        with ThreadPoolExecutor(max_workers=ALL_SERIES_FETCH_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(fetch_chunk, class_item, offset): (class_item, offset)
+                for class_item, offset in pending
+            }
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    class_item, offset = futures.pop(future)
+                    chunk = future.result()
+                    chunks[chunk_field(class_item, offset)] = chunk
+                    log('Fetched {0} series of {1} from offset {2}'.format(chunk['n'], class_item, offset))
+                    if chunk['n'] >= ALL_SERIES_CHUNK_SIZE:
+                        next_offset = offset + ALL_SERIES_CHUNK_SIZE
+                        futures[executor.submit(fetch_chunk, class_item, next_offset)] = \
+                            (class_item, next_offset)
+        result = sorted_by_label(
+            tuple(item_with_label)
+            for chunk in chunks.values()
+            for item_with_label in chunk['items']
+        )
+        # Everything's been fetched, so the next fetch should start afresh:
+        redis_delete(redis_api, CHUNKS_KEY)
+        redis_delete(redis_api, CLASSES_KEY)
+        return result
+    finally:
+        release_lock(redis_api, LOCK_KEY, token)
+
+
+def fetch_all_series(log=None):
+    '''Return a list of (item, label) tuples of every television series, sorted by label'''
+    if ALL_SERIES_FETCH_MODE == 'single-query':
+        return fetch_all_series_single_query()
+    return fetch_all_series_chunked(log)
@@ -0,0 +1,103 @@
+'''Pre-rendered, compressed pages of the list of all series
+
+Rendering the whole list on every request is expensive, so whenever
+the list is fetched it's split into pages of ALL_SERIES_PAGE_SIZE
+series, and each page is rendered once, compressed and stored in
+Redis along with an ETag. Serving a page is then just copying those
+bytes into the response.
+'''
+
+from datetime import datetime
+import gzip
+import hashlib
+from os import environ
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from cache import redis_api, redis_get, redis_get_object, redis_set, redis_set_object
+
+ALL_SERIES_PAGE_SIZE = int(environ.get('ALL_SERIES_PAGE_SIZE', '1000'))
+ALL_SERIES_PAGES_VERSION = 1
+
+# Content codings that pages are stored with, most preferred first:
+COMPRESSORS = [('gzip', lambda body: gzip.compress(body, 9))]
+if brotli is not None:
+    COMPRESSORS.insert(0, ('br', lambda body: brotli.compress(body)))
+
+
+class AllSeriesPages(object):
+    '''Describes the current set of pre-rendered pages'''
+
+    def __init__(self, generation, n_pages, last_modified, etags, page_first_labels):
+        self.generation = generation
+        self.n_pages = n_pages
+        self.last_modified = last_modified
+        self.etags = etags
+        self.page_first_labels = page_first_labels
+
+    @property
+    def last_modified_datetime(self):
+        return datetime.utcfromtimestamp(int(self.last_modified))
+
+
+def split_into_pages(items_with_labels):
+    return [
+        items_with_labels[i:i + ALL_SERIES_PAGE_SIZE]
+        for i in range(0, len(items_with_labels), ALL_SERIES_PAGE_SIZE)
+    ] or [[]]
+
+
+def pages_key():
+    return 'all-series-pages:v{0}'.format(ALL_SERIES_PAGES_VERSION)
+
+
+def page_key(generation, page, coding):
+    return 'all-series-page:v{0}:{1}:{2}:{3}'.format(
+        ALL_SERIES_PAGES_VERSION, generation, page, coding)
+
+
+def store_pages(rendered_pages, page_first_labels, last_modified, expires):
+    '''Compress and store rendered pages, then make them the current ones
+
+    rendered_pages is a list of the HTML of each page (numbered from
+    1) as bytes. The pages are all stored before the description of
+    them is replaced, so readers never see a mix of old and new
+    pages; the old ones just expire.'''
+    generation = '{0:.6f}'.format(last_modified)
+    etags = []
+    for page, body in enumerate(rendered_pages, 1):
+        etags.append(hashlib.sha1(body).hexdigest())
+        redis_set(redis_api, page_key(generation, page, 'identity'), body, expires)
+        for coding, compress in COMPRESSORS:
+            redis_set(redis_api, page_key(generation, page, coding), compress(body), expires)
+    pages = AllSeriesPages(
+        generation=generation,
+        n_pages=len(rendered_pages),
+        last_modified=last_modified,
+        etags=etags,
+        page_first_labels=page_first_labels,
+    )
+    redis_set_object(redis_api, pages_key(), pages, expires, purge=True)
+    return pages
+
+
+def get_pages():
+    return redis_get_object(redis_api, pages_key())
+
+
+def get_page_body(pages, page, accepted_codings):
+    '''Return the stored body of page and its content coding
+
+    accepted_codings is a function that says whether the client
+    accepts a given content coding. Returns (None, None) if the page
+    has expired from the cache.'''
+    for coding, _ in COMPRESSORS:
+        if accepted_codings(coding):
+            body = redis_get(redis_api, page_key(pages.generation, page, coding))
+            if body is not None:
+                return body, coding
+    body = redis_get(redis_api, page_key(pages.generation, page, 'identity'))
+    return body, (None if body is None else 'identity')
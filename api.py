@@ -0,0 +1,119 @@
+'''The JSON API's representations of series, episodes and reports
+
+These are made straight from a cached SeriesModel (see series.py), so
+answering the API never needs a template rendered or a query run for
+a series that's already cached. Clients can ask for only some fields
+of each episode with e.g. ?fields=item,name, which is worth doing for
+long series.
+'''
+
+import gzip
+import json
+
+from series import SERIES_MODEL_VERSION
+
+# The fields each episode can have, and how to get them:
+EPISODE_FIELDS = (
+    ('item', lambda episode: episode.item),
+    ('name', lambda episode: episode.name),
+    ('season_item', lambda episode: episode.season_item),
+    ('season_number', lambda episode: episode.season_number),
+    ('season_label', lambda episode: episode.season_label),
+    ('number_in_season', lambda episode: episode.episode_number_in_season),
+    ('episode_number', lambda episode: episode.episode_number),
+    ('production_code', lambda episode: episode.production_code),
+    ('previous_episode', lambda episode: episode.previous_episode_item),
+    ('next_episode', lambda episode: episode.next_episode_item),
+)
+EPISODE_FIELD_NAMES = tuple(name for name, _ in EPISODE_FIELDS)
+
+API_GZIP_LEVEL = 6
+
+
+class InvalidFields(Exception):
+    pass
+
+
+def parse_fields(fields_parameter):
+    '''Return the episode fields asked for by a comma-separated fields parameter
+
+    All the fields are returned if it's empty or missing, and
+    InvalidFields is raised if it names one that doesn't exist.'''
+    if not fields_parameter:
+        return EPISODE_FIELD_NAMES
+    fields = tuple(field.strip() for field in fields_parameter.split(',') if field.strip())
+    unknown = [field for field in fields if field not in EPISODE_FIELD_NAMES]
+    if unknown:
+        raise InvalidFields('Unknown fields: {0} (the fields are: {1})'.format(
+            ', '.join(unknown), ', '.join(EPISODE_FIELD_NAMES)))
+    return fields
+
+
+def episode_serializer(fields):
+    '''Return a function that turns an episode into a dict of just fields'''
+    getters = [(name, getter) for name, getter in EPISODE_FIELDS if name in fields]
+    return lambda episode: {name: getter(episode) for name, getter in getters}
+
+
+def series_etag(model, *variant):
+    '''Return an ETag for a representation of model
+
+    Cached models are never changed, only replaced, so a model is
+    identified by when it was built (and the version of the code that
+    built it); variant distinguishes different representations of it,
+    e.g. with different fields.'''
+    parts = [str(SERIES_MODEL_VERSION), model.series_item, repr(model.built_at)]
+    parts.extend(str(v) for v in variant)
+    return '-'.join(parts)
+
+
+def series_json(model):
+    return {
+        'series': model.series_item,
+        'name': model.series_name,
+        'uses_single_season_modelling': model.uses_single_season_modelling,
+    }
+
+
+def episodes_json(model, fields):
+    serialize = episode_serializer(fields)
+    result = series_json(model)
+    result['episodes'] = [serialize(episode) for episode in model.ordering.ordered_episodes]
+    return result
+
+
+def random_episode_json(model, episode, fields, pick, season):
+    result = series_json(model)
+    result.update({
+        'pick': pick,
+        'season': season,
+        'episode': episode_serializer(fields)(episode),
+    })
+    return result
+
+
+def report_json(series_item, series_name, report_items):
+    return {
+        'series': series_item,
+        'name': series_name,
+        'report': [
+            # The descriptions are wrapped in the source, so unwrap them:
+            {'ok': success, 'description': ' '.join(description.split())}
+            for success, description in report_items
+        ],
+    }
+
+
+def search_json(query, items_with_labels):
+    return {
+        'query': query,
+        'results': [{'series': item, 'name': label} for item, label in items_with_labels],
+    }
+
+
+def encode_json(value, coding):
+    '''Return value as compact JSON, compressed with coding ('gzip' or 'identity')'''
+    body = json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    if coding == 'gzip':
+        return gzip.compress(body, API_GZIP_LEVEL)
+    return body
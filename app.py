@@ -1,45 +1,84 @@
 #!/usr/bin/env python
 
 import cgi
-import json
+from datetime import datetime
 from os import environ
-import random
-import redis
 import re
+import time
+import uuid
 
-from flask import Flask, abort, redirect, render_template, request
+from flask import Flask, Response, abort, make_response, redirect, render_template, request
 from jinja2 import Markup
-from SPARQLWrapper import SPARQLWrapper, JSON, POST, GET
 from raven.contrib.flask import Sentry
 
+from all_series_fetch import FetchAlreadyRunning, fetch_all_series, fetch_running
+import api
+from all_series_pages import get_page_body, get_pages, split_into_pages, store_pages
+from cache import (
+    CACHE_POLICIES, redis_api, redis_get, redis_get_entry, redis_set, redis_set_entry,
+    redis_ttl)
+from cache_codec import from_payload, to_payload
 import problems
 import queries
-from episodes import Episode, group_and_order_episodes, id_from_item_url
-
-REDIS_PREFIX = environ.get('REDIS_PREFIX', None)
-REDIS_URL = environ.get('REDIS_URL', 'redis://localhost')
-
-QUERY_CACHE_EXPIRY = 3 * 60  # 3 minutes
-ALL_SERIES_CACHE_EXPIRY = 24 * 60 * 60  # 1 day
+from episodes import id_from_item_url
+from metrics import render_metrics
+from sampling import PICK_MODES
+from search_index import SearchIndexHolder
+from series import (
+    fetch_series_model, get_cached_series_model, series_queries, set_cached_series_model)
+from warming import record_series_request
+from wikidata import WikidataQueryService
 
 GOOGLE_ANALYTICS_PROPERTY_ID = environ.get('GOOGLE_ANALYTICS_PROPERTY_ID', '')
 
-
-def redis_key(key):
-    if not REDIS_PREFIX:
-        raise Exception('REDIS_PREFIX was not set in the environment')
-    return '{}:{}'.format(REDIS_PREFIX, key)
-
-
-def redis_set(redis_api, key, value, expires=None):
-    redis_api.set(redis_key(key), value, ex=expires)
-
-
-def redis_get(redis_api, key):
-    return redis_api.get(redis_key(key))
-
-
-redis_api = redis.StrictRedis.from_url(REDIS_URL, db=0)
+# Identifies a visitor's place in the shuffled order of episodes for
+# the 'no-repeat' pick mode (see sampling.py):
+SESSION_COOKIE = 'session-id'
+SESSION_COOKIE_MAX_AGE = 365 * 24 * 60 * 60
+
+# How long clients may use the API's series representations without
+# revalidating them (with their ETags):
+API_MAX_AGE = 60
+
+# Whether to fall back to searching with SPARQL if nothing in the
+# cached list of all series matches a search:
+SEARCH_SPARQL_FALLBACK = environ.get('SEARCH_SPARQL_FALLBACK', 'yes') == 'yes'
+SEARCH_RESULTS_LIMIT = int(environ.get('SEARCH_RESULTS_LIMIT', '200'))
+
+# When the cached list of all series was fetched, kept separately from
+# the (very large) list so that searches can check whether their index
+# is up to date without reading it:
+ALL_SERIES_FETCHED_AT_KEY = 'all-series-fetched-at'
+# If the list of all series isn't cached but is being fetched, a
+# request waits this long for it before giving up:
+ALL_SERIES_WAIT = 20
+ALL_SERIES_POLL_INTERVAL = 1
+
+search_index_holder = SearchIndexHolder()
+
+# The series linked to from the homepage, which the cache warmer
+# (see warming.py) keeps warm:
+EXAMPLES_OF_VARIOUS_QUALITY = [
+    ('Generally high quality data',
+     [
+         ('Q3577037', 'The West Wing'),
+         ('Q189350', '30 Rock'),
+         ('Q16290', 'Star Trek: TNG'),
+         ('Q2744', 'The X-Files'),
+         ('Q11622', 'Firefly'),
+         ('Q22908690', 'The Good Place'),
+         ('Q13417244', 'Brooklyn Nine-Nine'),
+         ('Q11598', 'Arrested Development'),
+     ]),
+    ('Data that could be improved',
+     [
+         ('Q2085', 'Twin Peaks'),
+     ]),
+    ('Low quality data - lots to do',
+     [
+         ('Q5902', 'Red Dwarf'),
+     ]),
+]
 
 
 app = Flask(__name__)
@@ -67,88 +106,12 @@ def linkify_report(report_items):
     ]
 
 
-class WikidataQuery(object):
-
-    def __init__(self, query, why=None):
-        self.query = query
-        self.why = why
-
-
-class WikidataQueryService(object):
-
-    def __init__(self, purge_cache=False):
-        self.queries = []
-        self.purge_cache = purge_cache
-
-    def _uncached_run_query(self, query, method=GET):
-        sparql = SPARQLWrapper('https://query.wikidata.org/sparql')
-        sparql.setReturnFormat(JSON)
-        sparql.setMethod(method)
-        sparql.setQuery(query)
-        return sparql.query().convert()
-
-    def run_query(self, query, why=None):
-        self.queries.append(WikidataQuery(query, why))
-        normalized_query = re.sub(r'\s+', ' ', query).strip()
-        key = 'query:{}'.format(normalized_query)
-        cached = redis_get(redis_api, key)
-        if cached is None or self.purge_cache:
-            method = POST if self.purge_cache else GET
-            result = self._uncached_run_query(normalized_query, method)
-            redis_set(redis_api, key, json.dumps(result), QUERY_CACHE_EXPIRY)
-        else:
-            result = json.loads(cached)
-        return result
-
-
-def parse_episodes(result_bindings):
-    all_episodes = [Episode(b) for b in result_bindings]
-    item_id_to_episode = {}
-    for episode in all_episodes:
-        item_id_to_episode[episode.item] = episode
-    problems = []
-    for episode in all_episodes:
-        if episode.previous_episode_item:
-            if episode.previous_episode_item in item_id_to_episode:
-                episode.previous_episode = item_id_to_episode[episode.previous_episode_item]
-            else:
-                fmt = '{0} follows {1}, but {1} was not found by the query'
-                problems.append(fmt.format(episode.label_with_item, episode.previous_episode_item))
-        if episode.next_episode_item:
-            if episode.next_episode_item in item_id_to_episode:
-                episode.next_episode = item_id_to_episode[episode.next_episode_item]
-            else:
-                fmt = '{0} followed by {1} but {1} was not found by the query'
-                problems.append(fmt.format(episode.label_with_item, episode.next_episode_item))
-    return all_episodes
-
-
 @app.route('/')
 def homepage():
     return render_template(
         'homepage.html',
         google_analytics_property_id=GOOGLE_ANALYTICS_PROPERTY_ID,
-        examples_of_various_quality=[
-            ('Generally high quality data',
-             [
-                 ('Q3577037', 'The West Wing'),
-                 ('Q189350', '30 Rock'),
-                 ('Q16290', 'Star Trek: TNG'),
-                 ('Q2744', 'The X-Files'),
-                 ('Q11622', 'Firefly'),
-                 ('Q22908690', 'The Good Place'),
-                 ('Q13417244', 'Brooklyn Nine-Nine'),
-                 ('Q11598', 'Arrested Development'),
-             ]),
-            ('Data that could be improved',
-             [
-                 ('Q2085', 'Twin Peaks'),
-             ]),
-            ('Low quality data - lots to do',
-             [
-                 ('Q5902', 'Red Dwarf'),
-             ]),
-        ],
+        examples_of_various_quality=EXAMPLES_OF_VARIOUS_QUALITY,
         title='Home',
     )
 
@@ -162,84 +125,251 @@ def about():
     )
 
 
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def search_series(query_service, query):
+    '''Return (item, label) for each series whose name contains query'''
+    # Search the cached list of all series if we have it, since that's
+    # much quicker than a regular expression search in SPARQL:
+    index = all_series_search_index()
+    items_with_labels = index.search(query, SEARCH_RESULTS_LIMIT) if index else []
+    if not items_with_labels and (index is None or SEARCH_SPARQL_FALLBACK):
+        escaped_query = re.sub(r'\\', r'\\\\', re.escape(query))
+        results = query_service.run_query(
+            queries.NAME_SUBSTRING_SEARCH.format(re_quoted_substring=escaped_query),
+            'Find TV series matching a substring',
+            cache_policy='search'
+        )
+        items_with_labels = [
+            (id_from_item_url(r['series']['value']), r['nameWithoutLang']['value'])
+            for r in results['results']['bindings'][:SEARCH_RESULTS_LIMIT]
+        ]
+    return items_with_labels
+
+
 @app.route('/search', methods=['POST'])
 def search():
     if 'q' not in request.form:
         raise Exception("Missing the search parameter")
     query_service = WikidataQueryService()
-    escaped_query = re.sub(r'\\', r'\\\\', re.escape(request.form['q']))
-    results = query_service.run_query(
-        queries.NAME_SUBSTRING_SEARCH.format(re_quoted_substring=escaped_query),
-        'Find TV series matching a substring'
-    )
-    items_with_labels = [
-        (id_from_item_url(r['series']['value']), r['nameWithoutLang']['value'])
-        for r in results['results']['bindings']
-    ]
+    items_with_labels = search_series(query_service, request.form['q'])
     return render_template(
         'search-results.html',
         query=request.form['q'],
         google_analytics_property_id=GOOGLE_ANALYTICS_PROPERTY_ID,
         items_with_labels=items_with_labels,
+        search_results_limit=SEARCH_RESULTS_LIMIT,
         queries_used=query_service.queries,
         title='Search results',
     )
 
 
-def slow_get_all_series():
-    sparql = SPARQLWrapper('https://query.wikidata.org/sparql')
-    sparql.setReturnFormat(JSON)
-    sparql.setQuery(queries.ALL_TV_SERIES)
-    results = sparql.query().convert()
-    return sorted(
-        (
-            (
-                id_from_item_url(r['series']['value']),
-                r['seriesLabel']['value']
-            )
-            for r in results['results']['bindings']
-            if not re.match('^Q\d+$', r['seriesLabel']['value'])
-        ),
-        key=lambda t: t[1]
-    )
+def cached_get_all_series_entry(purge_cache=False, fetch_if_missing=True):
+    '''Return the list of all series and the time it was fetched
+
+    If the list isn't cached this fetches it (which is very slow)
+    unless fetch_if_missing is False, in which case it returns None.
+    It also returns None if another process is already fetching it and
+    it isn't cached within ALL_SERIES_WAIT seconds.
+
+    A stale list is still returned, and not refreshed: fetching the
+    list takes far too long for a web worker, so that's left to
+    update-all-series-cache.'''
+    policy = CACHE_POLICIES['all-series']
+
+    def fetch_and_cache():
+        result = fetch_all_series()
+        _, fetched_at, _ = redis_set_entry(
+            redis_api, 'all-series', to_payload(result), policy, purge=purge_cache,
+            cache_locally=False)
+        redis_set(redis_api, ALL_SERIES_FETCHED_AT_KEY, repr(fetched_at), policy.hard_ttl)
+        render_all_series_pages(result, fetched_at)
+        return result, fetched_at
+
+    # The list is far too big to be worth keeping in the local cache:
+    entry = None if purge_cache else redis_get_entry(
+        redis_api, 'all-series', policy, cache_locally=False)
+    if entry is None:
+        if not fetch_if_missing:
+            return None
+        if purge_cache or not fetch_running():
+            try:
+                return fetch_and_cache()
+            except FetchAlreadyRunning:
+                if purge_cache:
+                    raise
+        # Wait for the fetch that's running to cache the list:
+        deadline = time.time() + ALL_SERIES_WAIT
+        while entry is None and fetch_running() and time.time() < deadline:
+            time.sleep(ALL_SERIES_POLL_INTERVAL)
+            entry = redis_get_entry(redis_api, 'all-series', policy, cache_locally=False)
+        if entry is None:
+            return None
+    payload, fetched_at, _ = entry
+    return from_payload(payload), fetched_at
 
 
 def cached_get_all_series(purge_cache=False):
-    cached = redis_get(redis_api, 'all-series')
-    if (cached is None) or purge_cache:
-        result = slow_get_all_series()
-        redis_set(redis_api, 'all-series', json.dumps(result), ALL_SERIES_CACHE_EXPIRY)
-    else:
-        result = json.loads(cached)
+    result, _ = cached_get_all_series_entry(purge_cache)
     return result
 
 
+def all_series_search_index():
+    '''Return a SearchIndex of all series, or None if the list isn't cached yet
+
+    The list itself is only read (and the index rebuilt) when it's
+    been fetched again since the index was built.'''
+    fetched_at = redis_get(redis_api, ALL_SERIES_FETCHED_AT_KEY)
+    if fetched_at is None:
+        # The list may have been cached before its fetched-at key was
+        # kept, so check for it:
+        entry = cached_get_all_series_entry(fetch_if_missing=False)
+        if entry is None:
+            return None
+        items_with_labels, fetched_at = entry
+        # It mustn't outlive the list:
+        ttl = redis_ttl(redis_api, 'all-series')
+        if ttl is not None:
+            redis_set(redis_api, ALL_SERIES_FETCHED_AT_KEY, repr(fetched_at), ttl)
+        return search_index_holder.get(fetched_at, lambda: items_with_labels)
+
+    def get_items_with_labels():
+        # The list can still have gone (e.g. evicted) before its
+        # fetched-at key, in which case there's no index:
+        entry = cached_get_all_series_entry(fetch_if_missing=False)
+        return None if entry is None else entry[0]
+
+    return search_index_holder.get(float(fetched_at), get_items_with_labels)
+
+
+def render_all_series_pages(items_with_labels, fetched_at):
+    '''Render, compress and store every page of the list of all series'''
+    page_items = split_into_pages(items_with_labels)
+    page_first_labels = [items[0][1] if items else '' for items in page_items]
+    rendered_pages = []
+    # This may run in a background refresh, outside any request:
+    with app.test_request_context('/series/'):
+        for page, items in enumerate(page_items, 1):
+            rendered_pages.append(render_template(
+                'all-series.html',
+                google_analytics_property_id=GOOGLE_ANALYTICS_PROPERTY_ID,
+                items_with_labels=items,
+                page=page,
+                page_first_labels=page_first_labels,
+                title='List of all television series (page {0} of {1})'.format(page, len(page_items)),
+            ).encode('utf-8'))
+    return store_pages(
+        rendered_pages,
+        page_first_labels,
+        fetched_at,
+        CACHE_POLICIES['all-series'].hard_ttl
+    )
+
+
 @app.route('/series/')
 def all_series():
+    page = request.args.get('page', 1, type=int)
+    pages = get_pages()
+    body = None
+    if pages is not None:
+        if not 1 <= page <= pages.n_pages:
+            abort(404)
+        body, coding = get_page_body(pages, page, lambda c: request.accept_encodings[c] > 0)
+    if body is None:
+        # The pages haven't been rendered yet (or have expired) so
+        # render them now:
+        entry = cached_get_all_series_entry()
+        if entry is None:
+            response = Response(
+                'The list of all series is being fetched; please try again in a few minutes',
+                status=503, mimetype='text/plain')
+            response.headers['Retry-After'] = '300'
+            return response
+        pages = render_all_series_pages(*entry)
+        if not 1 <= page <= pages.n_pages:
+            abort(404)
+        body, coding = get_page_body(pages, page, lambda c: request.accept_encodings[c] > 0)
+    response = Response(body, mimetype='text/html')
+    if coding != 'identity':
+        response.headers['Content-Encoding'] = coding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag('{0}-{1}'.format(pages.etags[page - 1], coding))
+    response.last_modified = pages.last_modified_datetime
+    response.cache_control.public = True
+    response.cache_control.max_age = 60 * 60
+    return response.make_conditional(request)
+
+
+def render_series_page(model, episode, show_random, pick='uniform', season=None):
     return render_template(
-        'all-series.html',
+        'random-episode.html',
         google_analytics_property_id=GOOGLE_ANALYTICS_PROPERTY_ID,
-        items_with_labels=cached_get_all_series(),
-        title='List of all television series',
+        show_random=show_random,
+        episode=episode,
+        pick=pick,
+        season=season,
+        seasons=model.sampler.seasons,
+        n_candidates=model.sampler.candidates(season)[0],
+        all_episodes=model.episodes,
+        uses_single_season_modelling=model.uses_single_season_modelling,
+        report_items=linkify_report(model.report_items),
+        episodes_table_data=model.episodes_table_data,
+        series_item=model.series_item,
+        queries_used=model.queries_used,
+        # The models are cached, so the queries' outcomes and timings
+        # are from when it was built rather than from this request:
+        queries_run_at=datetime.utcfromtimestamp(model.built_at),
+        title=model.series_name,
     )
 
 
-def get_episodes_multiseason(query_service, wikidata_item):
-    query = queries.MULTI_SEASON_QUERY_FMT.format(item=wikidata_item)
-    results = query_service.run_query(
-        query,
-        'Getting episodes of {0} assuming multi-season modelling'.format(wikidata_item)
-    )
-    return parse_episodes(results['results']['bindings'])
+def cached_series_model(query_service, wikidata_item, purge_cache=False):
+    '''Return whether wikidata_item is a television series and its SeriesModel
+
+    The model is None if no episodes could be found. The cached model
+    is used if there is one, and otherwise the one built is cached.'''
+    model = None if purge_cache else get_cached_series_model(wikidata_item)
+    if model is not None:
+        return True, model
+    # Look up the cached results of all the queries this might need
+    # (including those for the page saying no episodes were found) in
+    # one go:
+    queries_needed = series_queries(wikidata_item)
+    queries_needed.append(queries.SERIES_DIAGNOSTICS_FMT.format(item=wikidata_item))
+    query_service.prefetch(queries_needed)
+    is_tv_series, model = fetch_series_model(query_service, wikidata_item)
+    if model is not None:
+        set_cached_series_model(model, purge=purge_cache)
+    return is_tv_series, model
+
+
+def pick_episode(model, advance=True):
+    '''Pick an episode of model as the request's pick and season parameters ask
+
+    Returns the episode, the pick mode and season used and the
+    visitor's session ID. Unless advance is set, a 'no-repeat' pick
+    doesn't move on through the visitor's shuffled order.'''
+    pick = request.values.get('pick', 'uniform')
+    if pick not in PICK_MODES:
+        pick = 'uniform'
+    season = request.values.get('season', type=int)
+    if season not in model.sampler.seasons:
+        season = None
+    session_id = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+    if pick == 'no-repeat' and not advance:
+        episode = model.random_episode('uniform', season)
+    else:
+        episode = model.random_episode(pick, season, session_id)
+    return episode, pick, season, session_id
 
 
-def get_episodes_singleseason(query_service, wikidata_item):
-    query = queries.SINGLE_SEASON_QUERY_FMT.format(item=wikidata_item)
-    results = query_service.run_query(
-        query,
-        'Getting episodes of {0} assuming single-season modelling'.format(wikidata_item)
-    )
-    return parse_episodes(results['results']['bindings'])
+def remember_session(response, pick, session_id):
+    if pick == 'no-repeat' and SESSION_COOKIE not in request.cookies:
+        response.set_cookie(SESSION_COOKIE, session_id, max_age=SESSION_COOKIE_MAX_AGE, httponly=True)
+    return response
 
 
 @app.route('/series/<wikidata_item>', methods=['GET', 'POST'])
@@ -248,56 +378,140 @@ def random_episode(wikidata_item):
         abort(404)
     purge_cache = (request.method == 'POST') and (request.form.get('purge') == 'yes')
     query_service = WikidataQueryService(purge_cache)
-    # First check that the item we have actually is an instance of a
-    # 'television series' (Q5398426)
-    results = query_service.run_query(
-        queries.IS_ITEM_A_TV_SERIES_FMT.format(item=wikidata_item),
-        'Checking that {0} is really a television series'.format(wikidata_item)
-    )
-    if not results['boolean']:
+    is_tv_series, model = cached_series_model(query_service, wikidata_item, purge_cache)
+    if not is_tv_series:
         return '''{0} did not seem to be a television series (an 'instance of'
                   (P31) Q5398426 or something which is a 'subclass of' (P279)
                   Q5398426)'''.format(wikidata_item)
-    # Now get all episodes of that show, assuming it has the
-    # multi-season structure:
-    uses_single_season_modelling = False
-    episodes = get_episodes_multiseason(query_service, wikidata_item)
-    if not episodes:
-        episodes = get_episodes_singleseason(query_service, wikidata_item)
-        uses_single_season_modelling = True
-        if not episodes:
-            report_items = problems.report_extra_queries(query_service, wikidata_item)
-            report_items = linkify_report(report_items)
-            # Get the name of the series so that we can make the page more readable:
-            results = query_service.run_query(
-                queries.LABEL_FOR_ITEM_FMT.format(item=wikidata_item),
-                'Getting the Wikidata label (i.e. name) of {0} for a better error message'.format(wikidata_item))
-            series_name = results['results']['bindings'][0]['seriesLabel']['value']
-            return render_template(
-                'no-episodes.html',
-                google_analytics_property_id=GOOGLE_ANALYTICS_PROPERTY_ID,
-                report_items=report_items,
-                series_item=wikidata_item,
-                series_name=series_name,
-                queries_used=query_service.queries,
-                title='No episodes found of {0}'.format(series_name),
-            )
-    episodes_table_data, _ = group_and_order_episodes(episodes)
-    episode = random.choice(episodes)
-    return render_template(
-        'random-episode.html',
-        google_analytics_property_id=GOOGLE_ANALYTICS_PROPERTY_ID,
-        show_random=(request.method == 'POST'),
-        episode=episode,
-        all_episodes=episodes,
-        uses_single_season_modelling=uses_single_season_modelling,
-        report_items=linkify_report(problems.report(episodes)),
-        episodes_table_data=episodes_table_data,
-        series_item=wikidata_item,
-        queries_used=query_service.queries,
-        title=episodes[0].series_name,
+    if model is None:
+        # Find out what might be wrong with how the series is
+        # modelled, and its name so that we can make the page more
+        # readable, with a single query:
+        series_name, report_items = problems.fetch_diagnostics(query_service, wikidata_item)
+        report_items = linkify_report(report_items)
+        return render_template(
+            'no-episodes.html',
+            google_analytics_property_id=GOOGLE_ANALYTICS_PROPERTY_ID,
+            report_items=report_items,
+            series_item=wikidata_item,
+            series_name=series_name,
+            queries_used=query_service.queries,
+            title='No episodes found of {0}'.format(series_name),
+        )
+    record_series_request(wikidata_item)
+    show_random = (request.method == 'POST')
+    # Only move on through the shuffled order when the episode is
+    # actually shown:
+    episode, pick, season, session_id = pick_episode(model, advance=show_random)
+    response = make_response(render_series_page(model, episode, show_random, pick, season))
+    return remember_session(response, pick, session_id)
+
+
+def api_error(status, message):
+    response = Response(api.encode_json({'error': message}, 'identity'), status=status,
+                        mimetype='application/json')
+    response.cache_control.no_cache = True
+    return response
+
+
+def api_response(make_value, etag=None, last_modified=None, max_age=API_MAX_AGE):
+    '''Return a JSON response with the value make_value returns
+
+    If the client already has the representation with this etag, a 304
+    response is returned without calling make_value at all. The body is
+    gzipped if the client accepts that.'''
+    coding = 'gzip' if request.accept_encodings['gzip'] > 0 else 'identity'
+    if etag is not None:
+        etag = '{0}-{1}'.format(etag, coding)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+    response = Response(api.encode_json(make_value(), coding), mimetype='application/json')
+    if coding != 'identity':
+        response.headers['Content-Encoding'] = coding
+    response.headers['Vary'] = 'Accept-Encoding'
+    if etag is None:
+        response.cache_control.no_cache = True
+    else:
+        response.set_etag(etag)
+        response.last_modified = datetime.utcfromtimestamp(int(last_modified))
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+def api_series_model(wikidata_item):
+    '''Return the model of wikidata_item for the API, or an error response'''
+    if not re.search(r'^Q\d+$', wikidata_item):
+        return None, api_error(404, '{0} is not a Wikidata item ID'.format(wikidata_item))
+    is_tv_series, model = cached_series_model(WikidataQueryService(), wikidata_item)
+    if not is_tv_series:
+        return None, api_error(404, '{0} is not a television series'.format(wikidata_item))
+    if model is None:
+        return None, api_error(404, 'No episodes were found of {0}'.format(wikidata_item))
+    record_series_request(wikidata_item)
+    return model, None
+
+
+@app.route('/api/series/<wikidata_item>/episodes')
+def api_episodes(wikidata_item):
+    model, error = api_series_model(wikidata_item)
+    if error is not None:
+        return error
+    try:
+        fields = api.parse_fields(request.args.get('fields'))
+    except api.InvalidFields as e:
+        return api_error(400, str(e))
+    return api_response(
+        lambda: api.episodes_json(model, fields),
+        etag=api.series_etag(model, 'episodes', ','.join(fields)),
+        last_modified=model.built_at,
+    )
+
+
+@app.route('/api/series/<wikidata_item>/random')
+def api_random_episode(wikidata_item):
+    model, error = api_series_model(wikidata_item)
+    if error is not None:
+        return error
+    try:
+        fields = api.parse_fields(request.args.get('fields'))
+    except api.InvalidFields as e:
+        return api_error(400, str(e))
+    episode, pick, season, session_id = pick_episode(model)
+    response = api_response(lambda: api.random_episode_json(model, episode, fields, pick, season))
+    return remember_session(response, pick, session_id)
+
+
+@app.route('/api/series/<wikidata_item>/report')
+def api_report(wikidata_item):
+    if not re.search(r'^Q\d+$', wikidata_item):
+        return api_error(404, '{0} is not a Wikidata item ID'.format(wikidata_item))
+    query_service = WikidataQueryService()
+    is_tv_series, model = cached_series_model(query_service, wikidata_item)
+    if not is_tv_series:
+        return api_error(404, '{0} is not a television series'.format(wikidata_item))
+    if model is None:
+        # As on the page for a series with no episodes:
+        series_name, report_items = problems.fetch_diagnostics(query_service, wikidata_item)
+        return api_response(lambda: api.report_json(wikidata_item, series_name, report_items))
+    return api_response(
+        lambda: api.report_json(wikidata_item, model.series_name, model.report_items),
+        etag=api.series_etag(model, 'report'),
+        last_modified=model.built_at,
     )
 
 
+@app.route('/api/search')
+def api_search():
+    query = request.args.get('q')
+    if not query:
+        return api_error(400, 'Missing the search parameter q')
+    items_with_labels = search_series(WikidataQueryService(), query)
+    return api_response(lambda: api.search_json(query, items_with_labels))
+
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,211 @@
+'''Auditing the data quality of every television series at once
+
+audit-all-series runs problems.report for every series in the list of
+all series, to make a leaderboard of the best and worst modelled. The
+episodes of many series are fetched by each query (with
+queries.MULTI_SEASON_BATCH_QUERY_FMT and
+queries.SINGLE_SEASON_BATCH_QUERY_FMT), with at most
+AUDIT_QUERY_CONCURRENCY queries in flight at once, and the reports
+are made by a pool of worker processes.
+
+Each series' result is written to a local SQLite store as soon as it's
+done, so an audit that's interrupted carries on from where it got to
+when run again with the same store (unless it's started afresh).
+
+If fetching a batch fails (e.g. because the query timed out), it's
+split in half and each half tried again; a single series that can't be
+fetched is recorded as a failure and skipped, to be tried again by the
+next run.
+'''
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing import Pool
+from os import environ
+import json
+import os
+import sqlite3
+import time
+
+from episodes import id_from_item_url, order_episodes, parse_episodes
+import problems
+import queries
+from query_backends import query_backend
+
+AUDIT_BATCH_SIZE = int(environ.get('AUDIT_BATCH_SIZE', '50'))
+AUDIT_QUERY_CONCURRENCY = int(environ.get('AUDIT_QUERY_CONCURRENCY', '2'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS audits (
+  series TEXT PRIMARY KEY,
+  label TEXT,
+  episodes INTEGER NOT NULL,
+  single_season_modelling INTEGER NOT NULL,
+  problems INTEGER NOT NULL,
+  -- A JSON list of [success, description] report items:
+  report TEXT NOT NULL,
+  audited_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS audits_problems ON audits (problems, episodes);
+CREATE TABLE IF NOT EXISTS failures (
+  series TEXT PRIMARY KEY,
+  error TEXT NOT NULL,
+  failed_at REAL NOT NULL
+);
+'''
+
+NO_EPISODES_REPORT = [
+    (False, 'No episodes were found with either multi-season or single-season modelling'),
+]
+
+
+class AuditStore(object):
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM audits')
+            self.connection.execute('DELETE FROM failures')
+
+    def audited_series(self):
+        return set(row[0] for row in self.connection.execute('SELECT series FROM audits'))
+
+    def add_failure(self, series_item, error):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO failures VALUES (?, ?, ?)', (series_item, error, time.time()))
+
+    def add(self, audits):
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM failures WHERE series = ?', [(audit[0],) for audit in audits])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO audits VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (series_item, label, n_episodes, int(uses_single_season_modelling),
+                     sum(1 for success, _ in report_items if not success),
+                     json.dumps(report_items), time.time())
+                    for series_item, label, n_episodes, uses_single_season_modelling, report_items in audits
+                ]
+            )
+
+    def leaderboard(self, n, worst=True):
+        '''Return (series, label, episodes, problems) for the n series with the most (or fewest) problems
+
+        Only series with episodes are included; ties are broken in
+        favour of series with more episodes.'''
+        return self.connection.execute(
+            '''SELECT series, label, episodes, problems FROM audits WHERE episodes > 0
+               ORDER BY problems {0}, episodes DESC LIMIT ?'''.format('DESC' if worst else 'ASC'),
+            (n,)
+        ).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def group_by_series(bindings):
+    '''Split bindings into lists by series, keeping them in the same order'''
+    grouped = {}
+    for binding in bindings:
+        grouped.setdefault(id_from_item_url(binding['series']['value']), []).append(binding)
+    return grouped
+
+
+def fetch_batch(series_items):
+    '''Return (series, bindings, uses single-season modelling) for each of series_items
+
+    As on the series page, the single-season modelling is only used
+    for series with no episodes found with multi-season modelling.'''
+    values = ' '.join('wd:' + series_item for series_item in series_items)
+    multi_season = group_by_series(query_backend.run_query(
+        queries.MULTI_SEASON_BATCH_QUERY_FMT.format(series=values))['results']['bindings'])
+    single_season = group_by_series(query_backend.run_query(
+        queries.SINGLE_SEASON_BATCH_QUERY_FMT.format(series=values))['results']['bindings'])
+    return [
+        (series_item, multi_season[series_item], False) if series_item in multi_season
+        else (series_item, single_season.get(series_item, []), True)
+        for series_item in series_items
+    ]
+
+
+def audit_series(series_with_bindings):
+    '''Return (series, label, episodes, uses single-season modelling, report items) for a series
+
+    This runs in the worker processes.'''
+    series_item, bindings, uses_single_season_modelling = series_with_bindings
+    if not bindings:
+        return series_item, None, 0, uses_single_season_modelling, NO_EPISODES_REPORT
+    ordering = order_episodes(parse_episodes(bindings))
+    return (
+        series_item,
+        ordering.episodes[0].series_name,
+        len(ordering.episodes),
+        uses_single_season_modelling,
+        problems.report(ordering),
+    )
+
+
+def audit(series_items, store_path, restart=False, batch_size=AUDIT_BATCH_SIZE,
+          query_concurrency=AUDIT_QUERY_CONCURRENCY, processes=None, log=None):
+    '''Audit each of series_items, adding the results to the store at store_path
+
+    Series already in the store are skipped, unless restart is set.'''
+    log = log or (lambda message: None)
+    processes = processes or os.cpu_count() or 1
+    store = AuditStore(store_path)
+    if restart:
+        store.clear()
+    audited = store.audited_series()
+    remaining = [series_item for series_item in series_items if series_item not in audited]
+    log('{0} series to audit ({1} already audited)'.format(len(remaining), len(audited)))
+    batches = deque(
+        remaining[start:start + batch_size]
+        for start in range(0, len(remaining), batch_size)
+    )
+    started = time.time()
+    n_audited = 0
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers=query_concurrency) as executor, Pool(processes) as pool:
+        # Only query_concurrency batches are fetched at once, and the
+        # next isn't started until one has been audited, so the
+        # results waiting to be audited don't pile up:
+        futures = {}
+
+        def submit_next():
+            if batches:
+                batch = batches.popleft()
+                futures[executor.submit(fetch_batch, batch)] = batch
+
+        while batches and len(futures) < query_concurrency:
+            submit_next()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = futures.pop(future)
+                try:
+                    fetched = future.result()
+                except Exception as e:
+                    if len(batch) > 1:
+                        log('Fetching {0} series failed ({1}), so trying them in halves'.format(len(batch), e))
+                        middle = len(batch) // 2
+                        batches.extendleft([batch[middle:], batch[:middle]])
+                    else:
+                        log('Fetching {0} failed, so skipping it: {1}'.format(batch[0], e))
+                        store.add_failure(batch[0], str(e))
+                        n_failed += 1
+                    submit_next()
+                    continue
+                audits = pool.map(audit_series, fetched)
+                store.add(audits)
+                n_audited += len(audits)
+                log('{0} of {1} series audited ({2:.1f} series/s)'.format(
+                    n_audited, len(remaining), n_audited / (time.time() - started)))
+                submit_next()
+    store.close()
+    if n_failed:
+        log('{0} series could not be fetched; run again to retry them'.format(n_failed))
+    log('Finished in {0:.0f}s'.format(time.time() - started))
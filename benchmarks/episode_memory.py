@@ -0,0 +1,99 @@
+'''Compare the memory used by the old and current Episode representations
+
+Run from the top of the repository with:
+
+    python -m benchmarks.episode_memory [N_EPISODES [N_SEASONS]]
+'''
+
+import re
+import sys
+import tracemalloc
+
+from benchmarks.synthetic import series_result
+from episodes import Episode, link_episodes
+
+
+def legacy_id_from_item_url(url):
+    return re.sub(r'^http://www.wikidata.org/entity/', '', url)
+
+
+def legacy_int_if_present(binding, key):
+    if key in binding:
+        return int(binding[key]['value'])
+    return None
+
+
+def legacy_str_if_present(binding, key):
+    if key in binding:
+        return binding[key]['value']
+    return None
+
+
+def legacy_id_if_present(binding, key):
+    if key in binding:
+        return legacy_id_from_item_url(binding[key]['value'])
+    return None
+
+
+class LegacyEpisode(object):
+    '''Episode as it was before it had __slots__ and compact IDs'''
+
+    def __init__(self, binding):
+        self.name = binding['episodeLabel']['value']
+        self.series_name = binding['seriesLabel']['value']
+        self.item = legacy_id_from_item_url(binding['episode']['value'])
+        self.series_item = legacy_id_from_item_url(binding['series']['value'])
+        if 'season' in binding:
+            self.season_item = legacy_id_from_item_url(binding['season']['value'])
+            self.season_number = legacy_int_if_present(binding, 'seasonNumber')
+            self.season_label = binding['seasonLabel']['value']
+        else:
+            self.season_item = None
+            self.season_number = 1
+            self.season_label = None
+        self.episode_number_in_season = legacy_str_if_present(binding, 'numberInSeason')
+        self.episode_number = legacy_str_if_present(binding, 'episodeNumber')
+        self.production_code = legacy_str_if_present(binding, 'productionCode')
+        self.previous_episode_item = legacy_id_if_present(binding, 'previousEpisode')
+        self.previous_episode = None
+        self.next_episode_item = legacy_id_if_present(binding, 'nextEpisode')
+        self.next_episode = None
+        self.episodes_in_season = legacy_int_if_present(binding, 'episodesInSeason')
+        self.total_seasons = legacy_int_if_present(binding, 'totalSeasons')
+
+
+def legacy_link_episodes(all_episodes):
+    item_id_to_episode = {episode.item: episode for episode in all_episodes}
+    for episode in all_episodes:
+        if episode.previous_episode_item in item_id_to_episode:
+            episode.previous_episode = item_id_to_episode[episode.previous_episode_item]
+        if episode.next_episode_item in item_id_to_episode:
+            episode.next_episode = item_id_to_episode[episode.next_episode_item]
+
+
+def measure(episode_class, link, bindings):
+    '''Return the bytes still allocated for the linked episodes, and the peak'''
+    tracemalloc.start()
+    episodes = [episode_class(binding) for binding in bindings]
+    link(episodes)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del episodes
+    return retained, peak
+
+
+def main(n_episodes=20000, n_seasons=20):
+    bindings = series_result(n_episodes, n_seasons)['results']['bindings']
+    print('{0} episodes in {1} seasons:'.format(n_episodes, n_seasons))
+    results = [
+        ('legacy (__dict__)', measure(LegacyEpisode, legacy_link_episodes, bindings)),
+        ('current (__slots__)', measure(Episode, link_episodes, bindings)),
+    ]
+    legacy_retained = results[0][1][0]
+    for label, (retained, peak) in results:
+        print('  {0:<20} {1:>8.2f} MB retained {2:>8.2f} MB peak  {3:>6.1%} of legacy  ({4:.0f} bytes/episode)'.format(
+            label, retained / 1e6, peak / 1e6, retained / legacy_retained, retained / n_episodes))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,267 @@
+'''Benchmark the stages of building and rendering a series page
+
+These are what run for every series page that isn't already cached as
+a SeriesModel: parsing the episode query's bindings into Episodes,
+ordering and checking them (episodes.order_episodes), the problem
+report (problems.report) and rendering random-episode.html.
+
+Run from the top of the repository with:
+
+    python -m benchmarks.hot_path [--cases SUBSTRING] [--baseline FILE] [--save-baseline FILE]
+
+The cases are synthetic series (see benchmarks.synthetic) of 10, 1,000
+and 20,000 episodes, with single- and multi-season modelling and
+clean, broken, forked and cyclic 'follows' / 'followed by' chains,
+plus any real series whose query results have been recorded in the
+fixtures directory with:
+
+    python -m benchmarks.hot_path --record-fixtures
+
+which needs access to the Wikidata Query Service. None are kept in
+the repository yet, so until they're recorded the real series are
+skipped, and the benchmark lists which ones at the end. For each stage this
+reports the best time of several runs and, from a separate run with
+tracemalloc (which slows everything down), the peak memory allocated.
+
+With --save-baseline the results are saved as JSON; with --baseline
+they're compared to saved results, and the exit status is 1 if any
+stage got more than REGRESSION_THRESHOLD times slower or used more
+than that times as much memory (ignoring stages too quick or small
+to measure reliably). Baselines are only comparable on the
+same machine, so none is kept in the repository.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from benchmarks.synthetic import LINK_KINDS, series_result
+from episodes import order_episodes, parse_episodes
+import problems
+from query_backends import LiveBackend, QueryNotAvailable, RecordingBackend, ReplayBackend
+from series import SeriesModel, series_queries
+
+REPEATS = 5
+REGRESSION_THRESHOLD = 1.2
+# Stages quicker or smaller than these are too noisy to compare:
+MIN_COMPARABLE_SECONDS = 0.001
+MIN_COMPARABLE_BYTES = 64 * 1024
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+SYNTHETIC_SIZES = (
+    # (episodes, seasons)
+    (10, 1),
+    (1000, 20),
+    (20000, 200),
+)
+
+REAL_SERIES = (
+    ('Q2744', 'The X-Files'),
+    ('Q3577037', 'The West Wing'),
+    ('Q16290', 'Star Trek: TNG'),
+    ('Q2085', 'Twin Peaks'),
+    ('Q5902', 'Red Dwarf'),
+)
+
+STAGES = ('parse', 'order', 'report', 'render')
+
+
+class Case(object):
+
+    def __init__(self, name, series_item, bindings, uses_single_season_modelling):
+        self.name = name
+        self.series_item = series_item
+        self.bindings = bindings
+        self.uses_single_season_modelling = uses_single_season_modelling
+
+
+def synthetic_cases():
+    for n_episodes, n_seasons in SYNTHETIC_SIZES:
+        for multi_season in (True, False):
+            for links in LINK_KINDS:
+                result = series_result(
+                    n_episodes, n_seasons if multi_season else 1, multi_season, links=links)
+                name = 'synthetic-{0}-{1}-{2}'.format(
+                    n_episodes, 'multi' if multi_season else 'single', links)
+                yield Case(name, 'Q1', result['results']['bindings'], not multi_season)
+
+
+def real_case_name(series_item, label):
+    return '{0} ({1})'.format(label, series_item)
+
+
+def fixture_cases(directory, skipped):
+    '''Yield a Case for each of REAL_SERIES whose query results are recorded in directory
+
+    The names of those that aren't are appended to skipped.'''
+    backend = ReplayBackend(directory)
+    for series_item, label in REAL_SERIES:
+        _, multi_season_query, single_season_query = series_queries(series_item)
+        try:
+            multi_season_result = backend.run_query(multi_season_query)
+            single_season_result = backend.run_query(single_season_query)
+        except QueryNotAvailable:
+            skipped.append(real_case_name(series_item, label))
+            continue
+        # As in series.fetch_series_model, the single-season modelling
+        # is only used if there are no episodes with multi-season
+        # modelling:
+        bindings = multi_season_result['results']['bindings']
+        uses_single_season_modelling = not bindings
+        if uses_single_season_modelling:
+            bindings = single_season_result['results']['bindings']
+        if bindings:
+            yield Case(real_case_name(series_item, label), series_item, bindings,
+                       uses_single_season_modelling)
+
+
+def record_fixtures(directory):
+    backend = RecordingBackend(LiveBackend(), directory)
+    for series_item, label in REAL_SERIES:
+        print('Recording the episode queries for {0} ({1})'.format(label, series_item))
+        for query in series_queries(series_item)[1:]:
+            backend.run_query(query)
+
+
+def run_stages(case, render):
+    '''Yield the name of each stage and a function that runs it
+
+    Each stage uses what the one before it built, so they have to be
+    run in order.'''
+    state = {}
+
+    def parse():
+        state['episodes'] = parse_episodes(case.bindings)
+
+    def order():
+        state['ordering'] = order_episodes(state['episodes'])
+
+    def report():
+        state['report_items'] = problems.report(state['ordering'])
+
+    def render_page():
+        model = SeriesModel(
+            series_item=case.series_item,
+            uses_single_season_modelling=case.uses_single_season_modelling,
+            ordering=state['ordering'],
+            report_items=state['report_items'],
+            queries_used=[],
+        )
+        return render(model, model.episodes[0])
+
+    return zip(STAGES, (parse, order, report, render_page))
+
+
+def make_renderer():
+    from app import app, render_series_page
+
+    def render(model, episode):
+        with app.test_request_context('/series/{0}'.format(model.series_item), method='POST'):
+            return render_series_page(model, episode, show_random=True)
+    return render
+
+
+def measure_case(case, render):
+    '''Return {stage: {'seconds': ..., 'peak_bytes': ...}} for case'''
+    results = {}
+    for stage, run in run_stages(case, render):
+        times = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        results[stage] = {'seconds': min(times)}
+    for stage, run in run_stages(case, render):
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[stage]['peak_bytes'] = peak
+    return results
+
+
+def is_regression(value, baseline_value, minimum):
+    return max(value, baseline_value) >= minimum and value > REGRESSION_THRESHOLD * baseline_value
+
+
+def format_change(value, baseline_value, minimum):
+    if not baseline_value:
+        return ''
+    flag = ' !' if is_regression(value, baseline_value, minimum) else ''
+    return ' {0:>6.2f}x{1:<2}'.format(value / baseline_value, flag)
+
+
+def report_case(name, results, baseline):
+    '''Print the results for a case, returning whether any stage regressed'''
+    print(name)
+    regressed = False
+    for stage in STAGES:
+        seconds = results[stage]['seconds']
+        peak_bytes = results[stage]['peak_bytes']
+        line = '  {0:<8} {1:>10.3f} ms {2:>10.2f} MB peak'.format(
+            stage, seconds * 1000, peak_bytes / 1e6)
+        if baseline is not None and stage in baseline:
+            line += format_change(seconds, baseline[stage]['seconds'], MIN_COMPARABLE_SECONDS)
+            line += format_change(peak_bytes, baseline[stage]['peak_bytes'], MIN_COMPARABLE_BYTES)
+            regressed = regressed or is_regression(
+                seconds, baseline[stage]['seconds'], MIN_COMPARABLE_SECONDS)
+            regressed = regressed or is_regression(
+                peak_bytes, baseline[stage]['peak_bytes'], MIN_COMPARABLE_BYTES)
+        print(line)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark building and rendering series pages')
+    parser.add_argument('--cases', help='only run the cases whose names contain this')
+    parser.add_argument('--fixtures', default=FIXTURES_DIRECTORY,
+                        help='the directory of recorded query results')
+    parser.add_argument('--record-fixtures', action='store_true',
+                        help='record the query results for the real series, and exit')
+    parser.add_argument('--no-render', action='store_true',
+                        help='skip rendering the page (which needs the web app to be importable)')
+    parser.add_argument('--baseline', help='compare the results to those saved in this file')
+    parser.add_argument('--save-baseline', help='save the results to this file')
+    args = parser.parse_args()
+
+    if args.record_fixtures:
+        record_fixtures(args.fixtures)
+        return 0
+
+    render = (lambda model, episode: None) if args.no_render else make_renderer()
+    baselines = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    cases = list(synthetic_cases())
+    skipped = []
+    cases.extend(fixture_cases(args.fixtures, skipped))
+    all_results = {}
+    regressed = False
+    for case in cases:
+        if args.cases and args.cases not in case.name:
+            continue
+        all_results[case.name] = measure_case(case, render)
+        if report_case(case.name, all_results[case.name], baselines.get(case.name)):
+            regressed = True
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(all_results, f, indent=2, sort_keys=True)
+    skipped = [name for name in skipped if not args.cases or args.cases in name]
+    if skipped:
+        print('WARNING: skipped {0} real series with no recorded query results in {1}: {2}\n'
+              'Record them with: python -m benchmarks.hot_path --record-fixtures'.format(
+                  len(skipped), args.fixtures, ', '.join(skipped)), file=sys.stderr)
+    if regressed:
+        print('Some stages were more than {0}x slower or larger than the baseline (marked !)'.format(
+            REGRESSION_THRESHOLD))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
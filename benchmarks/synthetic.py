@@ -0,0 +1,128 @@
+'''Generators of synthetic SPARQL results for benchmarking
+
+These produce results in the same shape as the Wikidata Query
+Service's JSON for queries.MULTI_SEASON_QUERY_FMT and
+queries.SINGLE_SEASON_QUERY_FMT, for series of any size, with their
+'follows' / 'followed by' links either clean or broken in the ways
+that episodes.order_episodes has to cope with.
+'''
+
+ENTITY_PREFIX = 'http://www.wikidata.org/entity/'
+XSD_DECIMAL = 'http://www.w3.org/2001/XMLSchema#decimal'
+
+SERIES_ITEM_NUMBER = 100000000
+SEASON_ITEM_NUMBER_BASE = 200000000
+EPISODE_ITEM_NUMBER_BASE = 300000000
+
+MULTI_SEASON_VARS = [
+    'episodeLabel', 'episode', 'series', 'seriesLabel', 'season',
+    'numberInSeason', 'seasonNumber', 'seasonLabel', 'episodeNumber',
+    'productionCode', 'previousEpisode', 'nextEpisode', 'episodesInSeason',
+    'totalSeasons',
+]
+
+# How the 'follows' / 'followed by' links between episodes can be set
+# up by series_result:
+LINKS_CLEAN = 'clean'
+LINKS_BROKEN = 'broken'
+LINKS_FORKS = 'forks'
+LINKS_CYCLE = 'cycle'
+LINK_KINDS = (LINKS_CLEAN, LINKS_BROKEN, LINKS_FORKS, LINKS_CYCLE)
+
+# With broken links or forks, one in this many episodes is affected
+# (or more, in a series too short to have two of those):
+LINK_PROBLEM_INTERVAL = 50
+
+SINGLE_SEASON_VARS = [
+    'episodeLabel', 'episode', 'series', 'seriesLabel', 'episodeNumber',
+    'productionCode', 'previousEpisode', 'nextEpisode', 'episodesInSeason',
+    'totalSeasons',
+]
+
+
+def uri(item_number):
+    return {'type': 'uri', 'value': '{0}Q{1}'.format(ENTITY_PREFIX, item_number)}
+
+
+def literal(value, lang=None, datatype=None):
+    result = {'type': 'literal', 'value': str(value)}
+    if lang:
+        result['xml:lang'] = lang
+    if datatype:
+        result['datatype'] = datatype
+    return result
+
+
+def episode_item_number(index):
+    return EPISODE_ITEM_NUMBER_BASE + index
+
+
+def episode_links(n_episodes, links=LINKS_CLEAN):
+    '''Return the indices of the previous and next episode of each episode, or None
+
+    With LINKS_CLEAN the episodes are in a single chain. With
+    LINKS_BROKEN about every LINK_PROBLEM_INTERVAL-th episode is missing its
+    'followed by', splitting the chain; with LINKS_FORKS the episode
+    after next also claims to follow it. With LINKS_CYCLE
+    the last tenth of the episodes are cut off from the chain and
+    followed round in a loop.'''
+    previous_indices = [index - 1 if index > 0 else None for index in range(n_episodes)]
+    next_indices = [index + 1 if index < n_episodes - 1 else None for index in range(n_episodes)]
+    if links in (LINKS_BROKEN, LINKS_FORKS):
+        interval = max(3, min(LINK_PROBLEM_INTERVAL, n_episodes // 2))
+        for index in range(interval // 2, n_episodes - 2, interval):
+            if links == LINKS_BROKEN:
+                next_indices[index] = None
+            else:
+                previous_indices[index + 2] = index
+    elif links == LINKS_CYCLE and n_episodes >= 4:
+        cycle_start = n_episodes - max(2, n_episodes // 10)
+        next_indices[cycle_start - 1] = None
+        previous_indices[cycle_start] = n_episodes - 1
+        next_indices[n_episodes - 1] = cycle_start
+    elif links not in LINK_KINDS:
+        raise ValueError('Unknown kind of links: {0}'.format(links))
+    return previous_indices, next_indices
+
+
+def series_result(n_episodes, n_seasons=1, multi_season=True, series_name='Synthetic Series',
+                  links=LINKS_CLEAN):
+    '''Return a SPARQL JSON result for a synthetic series
+
+    The n_episodes episodes are split as evenly as possible between
+    n_seasons seasons, and linked by follows / followed by as links
+    says (see episode_links).'''
+    per_season = -(-n_episodes // n_seasons)
+    previous_indices, next_indices = episode_links(n_episodes, links)
+    bindings = []
+    for index in range(n_episodes):
+        season_index, index_in_season = divmod(index, per_season)
+        binding = {
+            'episode': uri(episode_item_number(index)),
+            'episodeLabel': literal('Episode {0}'.format(index + 1), lang='en'),
+            'series': uri(SERIES_ITEM_NUMBER),
+            'seriesLabel': literal(series_name, lang='en'),
+            'episodeNumber': literal(index + 1),
+            'productionCode': literal('{0}X{1:02d}'.format(season_index + 1, index_in_season + 1)),
+            'totalSeasons': literal(n_seasons, datatype=XSD_DECIMAL),
+        }
+        if previous_indices[index] is not None:
+            binding['previousEpisode'] = uri(episode_item_number(previous_indices[index]))
+        if next_indices[index] is not None:
+            binding['nextEpisode'] = uri(episode_item_number(next_indices[index]))
+        if multi_season:
+            n_in_season = min(per_season, n_episodes - season_index * per_season)
+            binding.update({
+                'season': uri(SEASON_ITEM_NUMBER_BASE + season_index),
+                'seasonLabel': literal('Season {0}'.format(season_index + 1), lang='en'),
+                'seasonNumber': literal(season_index + 1),
+                'numberInSeason': literal(index_in_season + 1),
+                'episodesInSeason': literal(n_in_season, datatype=XSD_DECIMAL),
+            })
+        else:
+            binding['episodesInSeason'] = literal(n_episodes, datatype=XSD_DECIMAL)
+        bindings.append(binding)
+    return {
+        'head': {'vars': MULTI_SEASON_VARS if multi_season else SINGLE_SEASON_VARS},
+        'results': {'bindings': bindings},
+    }
@@ -0,0 +1,281 @@
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+import pickle
+import time
+import uuid
+
+import redis
+
+import cache_codec
+from local_cache import LOCAL_CACHE_MAX_BYTES, InvalidationListener, LRUCache
+
+REDIS_PREFIX = environ.get('REDIS_PREFIX', None)
+REDIS_URL = environ.get('REDIS_URL', 'redis://localhost')
+
+QUERY_CACHE_EXPIRY = 3 * 60  # 3 minutes
+
+# If this is set, a cache entry older than its policy's soft TTL is
+# still used (until its hard TTL, when Redis expires it) while it's
+# refreshed in the background. Otherwise it's treated as a miss.
+STALE_WHILE_REVALIDATE = environ.get('STALE_WHILE_REVALIDATE', 'yes') == 'yes'
+REFRESH_CONCURRENCY = int(environ.get('REFRESH_CONCURRENCY', '2'))
+REFRESH_LOCK_TIMEOUT = 5 * 60
+
+
+class CachePolicy(object):
+
+    def __init__(self, name, soft_ttl, hard_ttl):
+        self.name = name
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+
+    def is_stale(self, fetched_at):
+        return time.time() - fetched_at > self.soft_ttl
+
+
+def cache_policy(name, default_soft_ttl, default_hard_ttl):
+    '''Make a CachePolicy, which can be overridden from the environment
+
+    e.g. CACHE_TTLS_EPISODES=3600,86400 sets soft and hard TTLs of an
+    hour and a day for the 'episodes' policy. A single TTL sets both,
+    for entries that are never revalidated before they expire.'''
+    variable = 'CACHE_TTLS_{}'.format(name.upper().replace('-', '_'))
+    if variable in environ:
+        ttls = [int(ttl) for ttl in environ[variable].split(',')]
+        soft_ttl, hard_ttl = ttls[0], ttls[-1]
+    else:
+        soft_ttl, hard_ttl = default_soft_ttl, default_hard_ttl
+    return CachePolicy(name, soft_ttl, hard_ttl)
+
+
+CACHE_POLICIES = {
+    policy.name: policy for policy in (
+        cache_policy('episodes', QUERY_CACHE_EXPIRY, 24 * 60 * 60),
+        cache_policy('search', QUERY_CACHE_EXPIRY, 60 * 60),
+        # Web processes never refresh the list of all series, however
+        # old it is (see app.cached_get_all_series_entry): only
+        # update-all-series-cache does. So it has no soft TTL, just
+        # the one it's kept for, which CACHE_TTLS_ALL_SERIES sets:
+        cache_policy('all-series', 7 * 24 * 60 * 60, 7 * 24 * 60 * 60),
+    )
+}
+
+
+def redis_key(key):
+    if not REDIS_PREFIX:
+        raise Exception('REDIS_PREFIX was not set in the environment')
+    return '{}:{}'.format(REDIS_PREFIX, key)
+
+
+def redis_set(redis_api, key, value, expires=None):
+    redis_api.set(redis_key(key), value, ex=expires)
+
+
+def redis_get(redis_api, key):
+    return redis_api.get(redis_key(key))
+
+
+def redis_ttl(redis_api, key):
+    '''Return the number of seconds until key expires, or None if it doesn't exist or expire'''
+    ttl = redis_api.ttl(redis_key(key))
+    if ttl is None or ttl < 0:
+        return None
+    return ttl
+
+
+def redis_delete(redis_api, key):
+    redis_api.delete(redis_key(key))
+
+
+def redis_purge(redis_api, key):
+    '''Delete key, and tell other processes to drop any copy in their local caches'''
+    redis_delete(redis_api, key)
+    invalidation_listener.publish(key)
+
+
+def invalidate_local_caches(key):
+    '''Tell other processes to drop any copy of key in their local caches'''
+    invalidation_listener.publish(key)
+
+
+def redis_hset(redis_api, key, field, value, expires=None):
+    pipeline = redis_api.pipeline()
+    pipeline.hset(redis_key(key), field, value)
+    if expires is not None:
+        pipeline.expire(redis_key(key), expires)
+    pipeline.execute()
+
+
+def redis_hgetall(redis_api, key):
+    return redis_api.hgetall(redis_key(key))
+
+
+def redis_set_object(redis_api, key, value, expires=None, purge=False):
+    '''Cache value pickled (and compressed), and in this process's local cache
+
+    redis_api may be a pipeline, to send the SET along with other
+    writes; the local cache is updated straight away regardless. In
+    that case, use invalidate_local_caches once the pipeline has been
+    executed rather than purge, or other processes might reload the
+    old value before the new one is written.'''
+    pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    redis_set(redis_api, key, cache_codec.compress(pickled), expires)
+    if purge:
+        invalidation_listener.publish(key)
+    if expires is not None:
+        local_cache.set(key, value, expires, len(pickled))
+
+
+def redis_get_object(redis_api, key):
+    invalidation_listener.ensure_started()
+    value = local_cache.get(key)
+    if value is not None:
+        return value
+    pipeline = redis_api.pipeline(transaction=False)
+    pipeline.get(redis_key(key))
+    pipeline.ttl(redis_key(key))
+    cached, ttl = pipeline.execute()
+    if cached is None:
+        return None
+    try:
+        pickled = cache_codec.decompress(cached)
+        value = pickle.loads(pickled)
+    except Exception:
+        # An entry written by an incompatible version of the code (or
+        # compressed with something this process doesn't have) is
+        # treated as a cache miss rather than breaking the page:
+        return None
+    if ttl is not None and ttl > 0:
+        local_cache.set(key, value, ttl, len(pickled))
+    return value
+
+
+def _cache_entry_locally(key, entry, policy):
+    # Only keep the entry locally until it goes stale, so that
+    # revalidation is still decided by what's in Redis:
+    _, fetched_at, size = entry
+    local_cache.set(key, entry, fetched_at + policy.soft_ttl - time.time(), size)
+
+
+def redis_get_entry(redis_api, key, policy, cache_locally=True):
+    '''Return the payload, the time it was fetched and its encoded size for key
+
+    Returns None if key isn't cached. The payload is in the form
+    cache_codec uses (e.g. columns rather than bindings for SPARQL
+    results); cache_codec.from_payload turns it back into the value
+    that was cached. This process's local cache is tried before
+    Redis, unless cache_locally is False, which is for entries too big
+    to be worth keeping there.'''
+    if cache_locally:
+        invalidation_listener.ensure_started()
+        entry = local_cache.get(key)
+        if entry is not None:
+            return entry
+    cached = redis_get(redis_api, key)
+    if cached is None:
+        return None
+    return _decode_entry(key, cached, policy, cache_locally)
+
+
+def _decode_entry(key, cached, policy, cache_locally=True):
+    entry = cache_codec.decode_payload(cached) + (len(cached),)
+    if cache_locally:
+        _cache_entry_locally(key, entry, policy)
+    return entry
+
+
+def redis_get_entries(redis_api, keys, policy):
+    '''Return a dict mapping each of keys to its entry, as redis_get_entry would
+
+    Whichever of keys aren't in this process's local cache are all
+    fetched from Redis with a single MGET.'''
+    invalidation_listener.ensure_started()
+    entries = {}
+    missing = []
+    for key in keys:
+        entries[key] = local_cache.get(key)
+        if entries[key] is None:
+            missing.append(key)
+    if missing:
+        for key, cached in zip(missing, redis_api.mget([redis_key(key) for key in missing])):
+            if cached is not None:
+                entries[key] = _decode_entry(key, cached, policy)
+    return entries
+
+
+def redis_set_entry(redis_api, key, payload, policy, purge=False, cache_locally=True):
+    '''Cache a payload (see cache_codec) as just fetched, for the hard TTL of policy
+
+    Returns the entry, as redis_get_entry would.
+
+    If purge is set, other processes are told to drop any copy of the
+    entry they have in their local caches. cache_locally is as for
+    redis_get_entry.'''
+    fetched_at = time.time()
+    encoded = cache_codec.encode_payload(payload, fetched_at)
+    entry = (payload, fetched_at, len(encoded))
+    redis_set(redis_api, key, encoded, policy.hard_ttl)
+    if purge:
+        invalidation_listener.publish(key)
+    if cache_locally:
+        _cache_entry_locally(key, entry, policy)
+    return entry
+
+
+def redis_incr(redis_api, key, amount=1):
+    return redis_api.incr(redis_key(key), amount)
+
+
+# Only delete the lock if it still holds our token, so that a worker
+# whose lock expired can't release a lock since taken by another one:
+RELEASE_LOCK_SCRIPT = '''
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+else
+    return 0
+end'''
+
+
+def acquire_lock(redis_api, key, timeout):
+    '''Try to take the lock called key, returning a token if successful or None
+
+    The lock expires after timeout seconds even if it isn't released,
+    so a worker that dies while holding it can't block others forever.'''
+    token = uuid.uuid4().hex
+    if redis_api.set(redis_key(key), token, ex=timeout, nx=True):
+        return token
+    return None
+
+
+def release_lock(redis_api, key, token):
+    redis_api.eval(RELEASE_LOCK_SCRIPT, 1, redis_key(key), token)
+
+
+refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_CONCURRENCY)
+
+
+def schedule_refresh(redis_api, key, refresh):
+    '''Call refresh in the background to replace the stale cache entry key
+
+    Only one worker refreshes a given key at a time; if another one
+    already is, this does nothing.'''
+    lock_key = 'refresh-lock:{}'.format(key)
+    token = acquire_lock(redis_api, lock_key, REFRESH_LOCK_TIMEOUT)
+    if token is None:
+        return
+
+    def run_refresh():
+        try:
+            refresh()
+            redis_incr(redis_api, 'stats:cache-refreshes')
+        finally:
+            release_lock(redis_api, lock_key, token)
+
+    refresh_executor.submit(run_refresh)
+
+
+redis_api = redis.StrictRedis.from_url(REDIS_URL, db=0)
+
+local_cache = LRUCache(LOCAL_CACHE_MAX_BYTES)
+invalidation_listener = InvalidationListener(
+    redis_api, redis_key('local-cache-invalidations'), local_cache)
@@ -0,0 +1,361 @@
+'''Compact encoding of cached values, and SPARQL results in particular
+
+The JSON that the Wikidata Query Service returns repeats the full
+entity URI and the type of every value in every binding. Results are
+stored instead as one column per variable, with entity URIs reduced
+to their IDs (or just the number, for Q-ids), language tags and
+datatypes interned, and columns with few distinct values dictionary
+encoded. That's then serialized (with msgpack if it's installed) and
+compressed (with zstd if it's installed).
+
+Every encoded value starts with a header:
+
+    magic (4 bytes) | format version | serializer | compression | fetched_at
+
+where the last is a big-endian double. Anything without the magic
+bytes is assumed to be JSON written before this module existed.
+
+Other bytes (e.g. pickled objects) can be compressed the same way
+with compress, which starts them with COMPRESSED_MAGIC and the
+compression used.
+'''
+
+from os import environ
+import json
+import struct
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'WTVC'
+COMPRESSED_MAGIC = b'WTVZ'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('>4sBcc d')
+
+ENTITY_PREFIX = 'http://www.wikidata.org/entity/'
+
+# The kinds of value a cell of a column can hold:
+UNBOUND = '0'
+ITEM = '1'             # value is the number of a Q-id
+ENTITY = '2'           # value is the rest of a non-item entity URI
+URI = '3'
+LITERAL = '4'
+LANG_LITERAL = '5'     # next extra is the index of the language tag
+TYPED_LITERAL = '6'    # next extra is the index of the datatype
+BNODE = '7'
+OTHER = '9'            # next extra is the whole binding value
+
+DICTIONARY_ENCODING_RATIO = 0.5
+
+
+def _json_dumps(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _json_loads(data):
+    return json.loads(data.decode('utf-8'))
+
+
+SERIALIZERS = {
+    b'j': (_json_dumps, _json_loads),
+}
+if msgpack is not None:
+    SERIALIZERS[b'm'] = (
+        lambda value: msgpack.packb(value, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+    )
+
+COMPRESSORS = {
+    b'n': (lambda data: data, lambda data: data),
+    b'z': (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+if zstandard is not None:
+    COMPRESSORS[b's'] = (
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+SERIALIZER_NAMES = {'json': b'j', 'msgpack': b'm'}
+COMPRESSION_NAMES = {'none': b'n', 'zlib': b'z', 'zstd': b's'}
+
+
+def _configured(variable, names, available, preferences):
+    if variable in environ:
+        code = names[environ[variable]]
+        if code not in available:
+            raise Exception('{0}={1} is not available'.format(variable, environ[variable]))
+        return code
+    return next(code for code in preferences if code in available)
+
+
+SERIALIZER = _configured(
+    'CACHE_CODEC_SERIALIZER', SERIALIZER_NAMES, SERIALIZERS, [b'm', b'j'])
+COMPRESSION = _configured(
+    'CACHE_CODEC_COMPRESSION', COMPRESSION_NAMES, COMPRESSORS, [b's', b'z'])
+
+
+class ColumnBuilder(object):
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.kinds = []
+        self.values = []
+        self.extras = []
+
+    def add(self, binding_value):
+        if binding_value is None:
+            self.kinds.append(UNBOUND)
+            self.values.append(None)
+            return
+        value_type = binding_value.get('type')
+        value = binding_value.get('value')
+        n_keys = len(binding_value)
+        if value_type == 'uri' and n_keys == 2:
+            if value.startswith(ENTITY_PREFIX):
+                entity_id = value[len(ENTITY_PREFIX):]
+                if entity_id[:1] == 'Q' and entity_id[1:].isdigit() and entity_id[1] != '0':
+                    self.kinds.append(ITEM)
+                    self.values.append(int(entity_id[1:]))
+                else:
+                    self.kinds.append(ENTITY)
+                    self.values.append(entity_id)
+            else:
+                self.kinds.append(URI)
+                self.values.append(value)
+        elif value_type == 'literal' and n_keys == 2:
+            self.kinds.append(LITERAL)
+            self.values.append(value)
+        elif value_type == 'literal' and n_keys == 3 and 'xml:lang' in binding_value:
+            self.kinds.append(LANG_LITERAL)
+            self.values.append(value)
+            self.extras.append(self.tags.intern(binding_value['xml:lang']))
+        elif value_type in ('literal', 'typed-literal') and n_keys == 3 and 'datatype' in binding_value:
+            if value_type == 'typed-literal':
+                self.kinds.append(OTHER)
+                self.values.append(None)
+                self.extras.append(binding_value)
+            else:
+                self.kinds.append(TYPED_LITERAL)
+                self.values.append(value)
+                self.extras.append(self.tags.intern(binding_value['datatype']))
+        elif value_type == 'bnode' and n_keys == 2:
+            self.kinds.append(BNODE)
+            self.values.append(value)
+        else:
+            self.kinds.append(OTHER)
+            self.values.append(None)
+            self.extras.append(binding_value)
+
+    def encode(self):
+        column = {'k': ''.join(self.kinds), 'v': self.values}
+        if self.extras:
+            column['x'] = self.extras
+        distinct = {}
+        for value in self.values:
+            if value not in distinct:
+                distinct[value] = len(distinct)
+        if len(distinct) < DICTIONARY_ENCODING_RATIO * len(self.values):
+            column['d'] = list(distinct)
+            column['v'] = [distinct[value] for value in self.values]
+        return column
+
+
+class InternTable(object):
+
+    def __init__(self):
+        self.values = []
+        self.indices = {}
+
+    def intern(self, value):
+        index = self.indices.get(value)
+        if index is None:
+            index = len(self.values)
+            self.values.append(value)
+            self.indices[value] = index
+        return index
+
+
+class SelectResultBuilder(object):
+    '''Builds the columnar form of a SELECT query's result a binding at a time'''
+
+    def __init__(self, head):
+        self.head = head
+        self.tags = InternTable()
+        self.columns = [
+            (variable, ColumnBuilder(self.tags))
+            for variable in head.get('vars', [])
+        ]
+        self.variables = set(variable for variable, _ in self.columns)
+        self.n = 0
+
+    def add(self, binding):
+        for variable, column in self.columns:
+            column.add(binding.get(variable))
+        for variable in binding:
+            if variable not in self.variables:
+                # A variable that isn't in the head; give it a column
+                # that is unbound in every earlier binding:
+                column = ColumnBuilder(self.tags)
+                for _ in range(self.n):
+                    column.add(None)
+                column.add(binding[variable])
+                self.columns.append((variable, column))
+                self.variables.add(variable)
+        self.n += 1
+
+    def tee(self, bindings):
+        '''Yield each of bindings, adding it to the result as it goes past'''
+        for binding in bindings:
+            self.add(binding)
+            yield binding
+
+    def encode(self):
+        return {
+            'kind': 'select',
+            'head': self.head,
+            'n': self.n,
+            'tags': self.tags.values,
+            'columns': [[variable, column.encode()] for variable, column in self.columns],
+        }
+
+
+def _iter_column(column, tags):
+    values = column['v']
+    if 'd' in column:
+        dictionary = column['d']
+        values = (dictionary[index] for index in values)
+    extras = iter(column.get('x', ()))
+    for kind, value in zip(column['k'], values):
+        if kind == UNBOUND:
+            yield None
+        elif kind == ITEM:
+            yield {'type': 'uri', 'value': '{0}Q{1}'.format(ENTITY_PREFIX, value)}
+        elif kind == ENTITY:
+            yield {'type': 'uri', 'value': ENTITY_PREFIX + value}
+        elif kind == URI:
+            yield {'type': 'uri', 'value': value}
+        elif kind == LITERAL:
+            yield {'type': 'literal', 'value': value}
+        elif kind == LANG_LITERAL:
+            yield {'type': 'literal', 'value': value, 'xml:lang': tags[next(extras)]}
+        elif kind == TYPED_LITERAL:
+            yield {'type': 'literal', 'value': value, 'datatype': tags[next(extras)]}
+        elif kind == BNODE:
+            yield {'type': 'bnode', 'value': value}
+        else:
+            yield next(extras)
+
+
+def iter_bindings(payload):
+    '''Yield the bindings of a columnar SELECT result one at a time
+
+    Each binding is only decoded as it's needed, so this doesn't
+    build the whole list of bindings.'''
+    if not payload['columns']:
+        for _ in range(payload['n']):
+            yield {}
+        return
+    tags = payload['tags']
+    variables = [variable for variable, _ in payload['columns']]
+    columns = [_iter_column(column, tags) for _, column in payload['columns']]
+    for row in zip(*columns):
+        yield {
+            variable: value
+            for variable, value in zip(variables, row)
+            if value is not None
+        }
+
+
+def is_select_result(value):
+    if not isinstance(value, dict) or set(value) != {'head', 'results'}:
+        return False
+    return set(value['results']) == {'bindings'}
+
+
+def to_payload(value):
+    if is_select_result(value):
+        builder = SelectResultBuilder(value['head'])
+        for binding in value['results']['bindings']:
+            builder.add(binding)
+        return builder.encode()
+    return {'kind': 'value', 'value': value}
+
+
+def from_payload(payload):
+    if payload['kind'] == 'select':
+        return {
+            'head': payload['head'],
+            'results': {'bindings': list(iter_bindings(payload))},
+        }
+    return payload['value']
+
+
+def payload_rows(payload):
+    '''Return the number of bindings in a SELECT result's payload, or 1 for any other value'''
+    if payload['kind'] == 'select':
+        return payload['n']
+    return 1
+
+
+def encode_payload(payload, fetched_at=None, serializer=None, compression=None):
+    if fetched_at is None:
+        fetched_at = time.time()
+    serializer = serializer or SERIALIZER
+    compression = compression or COMPRESSION
+    serialize, _ = SERIALIZERS[serializer]
+    compress, _ = COMPRESSORS[compression]
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, serializer, compression, fetched_at)
+    return header + compress(serialize(payload))
+
+
+def decode_payload(data):
+    '''Return the payload and the time it was fetched from encoded data'''
+    if data[:len(MAGIC)] != MAGIC:
+        # Entries from before this codec are JSON, either wrapped with
+        # the time they were fetched or (older still) the bare value,
+        # which is treated as already stale:
+        entry = json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+        if isinstance(entry, dict) and 'fetched_at' in entry and 'value' in entry:
+            return to_payload(entry['value']), entry['fetched_at']
+        return to_payload(entry), 0
+    _, version, serializer, compression, fetched_at = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError('Unknown cache codec format version {0}'.format(version))
+    _, deserialize = SERIALIZERS[serializer]
+    _, decompress = COMPRESSORS[compression]
+    return deserialize(decompress(data[HEADER.size:])), fetched_at
+
+
+def encode(value, fetched_at=None, serializer=None, compression=None):
+    return encode_payload(to_payload(value), fetched_at, serializer, compression)
+
+
+def decode(data):
+    '''Return the value and the time it was fetched from encoded data'''
+    payload, fetched_at = decode_payload(data)
+    return from_payload(payload), fetched_at
+
+
+def compress(data, compression=None):
+    '''Return data compressed, marked with how so that decompress can undo it'''
+    compression = compression or COMPRESSION
+    compress_data, _ = COMPRESSORS[compression]
+    return COMPRESSED_MAGIC + compression + compress_data(data)
+
+
+def decompress(data):
+    '''Return data as it was before compress; anything not from compress is returned as it is'''
+    if data[:len(COMPRESSED_MAGIC)] != COMPRESSED_MAGIC:
+        return data
+    compression = data[len(COMPRESSED_MAGIC):len(COMPRESSED_MAGIC) + 1]
+    _, decompress_data = COMPRESSORS[compression]
+    return decompress_data(data[len(COMPRESSED_MAGIC) + 1:])
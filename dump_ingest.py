@@ -0,0 +1,200 @@
+'''Building an episode store (see episode_store.py) from a Wikidata JSON dump
+
+The dump (latest-all.json.bz2 or .gz, or any file in the same format,
+such as a subset with one entity per line) is read a line at a time.
+Batches of lines are parsed by a pool of worker processes, which
+return just the rows to store for the series, seasons and episodes in
+them. Only a bounded number of batches are in flight at once, so
+memory use doesn't grow with the size of the dump.
+
+Which items are series and episodes is decided by their P31
+(instance of) classes, so the subclasses of 'television series' and
+'television series episode' have to be known before reading the dump.
+'''
+
+import bz2
+import gzip
+import json
+from multiprocessing import Pool
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from episode_store import INDEXES, SCHEMA, STORED_PROPERTIES
+from episodes import id_from_item_url
+import queries
+from query_backends import query_backend
+
+SEASON_CLASS = 'Q3464665'
+
+BATCH_SIZE = 1000
+BATCHES_IN_FLIGHT_PER_PROCESS = 4
+
+# Set in each worker process by init_worker:
+series_classes = frozenset()
+episode_classes = frozenset()
+
+
+def fetch_classes():
+    '''Return the subclasses of television series and of episodes from the query service'''
+    def subclasses(query):
+        results = query_backend.run_query(query)
+        return sorted(id_from_item_url(b['class']['value']) for b in results['results']['bindings'])
+    return {
+        'series': subclasses(queries.TV_SERIES_CLASSES),
+        'episode': subclasses(queries.EPISODE_CLASSES),
+    }
+
+
+def open_dump(path):
+    if path == '-':
+        return sys.stdin.buffer
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_batches(dump, batch_size=BATCH_SIZE):
+    batch = []
+    for line in dump:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def init_worker(classes):
+    global series_classes, episode_classes
+    series_classes = frozenset(classes['series'])
+    episode_classes = frozenset(classes['episode'])
+
+
+def snak_value(snak):
+    '''Return the value of a snak as it's stored, or None if it has no value'''
+    if snak.get('snaktype') != 'value':
+        return None
+    datavalue = snak['datavalue']
+    if datavalue['type'] == 'wikibase-entityid':
+        return datavalue['value'].get('numeric-id')
+    if datavalue['type'] == 'quantity':
+        return datavalue['value']['amount'].lstrip('+')
+    if datavalue['type'] == 'string':
+        return datavalue['value']
+    return None
+
+
+def best_statements(statements):
+    '''Return the statements that wdt: would match: the preferred ones, if any, otherwise the normal ones'''
+    preferred = [s for s in statements if s.get('rank') == 'preferred']
+    return preferred or [s for s in statements if s.get('rank') == 'normal']
+
+
+def extract_entity(entity):
+    '''Return the rows to store for an entity, or None if it isn't a series, season or episode'''
+    if entity.get('type') != 'item':
+        return None
+    claims = entity.get('claims', {})
+    classes = {
+        'Q{0}'.format(snak_value(s['mainsnak']))
+        for s in best_statements(claims.get('P31', []))
+        if snak_value(s['mainsnak']) is not None
+    }
+    is_series = not classes.isdisjoint(series_classes)
+    is_season = SEASON_CLASS in classes
+    is_episode = not classes.isdisjoint(episode_classes)
+    if not (is_series or is_season or is_episode):
+        return None
+    item = int(entity['id'][1:])
+    label = entity.get('labels', {}).get('en', {}).get('value')
+    statement_rows = []
+    for prop in STORED_PROPERTIES:
+        statements = claims.get(prop, [])
+        best = set(id(s) for s in best_statements(statements))
+        for statement in statements:
+            value = snak_value(statement['mainsnak'])
+            if value is None:
+                continue
+            ordinals = [
+                snak_value(qualifier)
+                for qualifier in statement.get('qualifiers', {}).get('P1545', [])
+                if snak_value(qualifier) is not None
+            ] or [None]
+            for ordinal in ordinals:
+                statement_rows.append((item, prop, value, ordinal, int(id(statement) in best)))
+    return (item, label, int(is_series), int(is_season), int(is_episode)), statement_rows
+
+
+def extract_batch(lines):
+    '''Parse a batch of lines from a dump, returning the rows to store and the number of entities'''
+    entity_rows = []
+    statement_rows = []
+    n_entities = 0
+    for line in lines:
+        line = line.strip().rstrip(b',')
+        if not line or line in (b'[', b']'):
+            continue
+        n_entities += 1
+        rows = extract_entity(json.loads(line.decode('utf-8')))
+        if rows is not None:
+            entity_rows.append(rows[0])
+            statement_rows.extend(rows[1])
+    return entity_rows, statement_rows, n_entities
+
+
+def ingest(dump_path, store_path, classes, processes=None, log=None):
+    '''Build a new episode store at store_path from the dump at dump_path
+
+    The store is written to a temporary file which then replaces any
+    existing store, so the app can carry on reading the old one while
+    this runs.'''
+    log = log or (lambda message: None)
+    processes = processes or os.cpu_count() or 1
+    temporary_path = store_path + '.tmp'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    connection = sqlite3.connect(temporary_path)
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.executescript(SCHEMA)
+    # The task handler thread of Pool.imap reads its input as fast as it
+    # can, so this stops it reading more of the dump until earlier
+    # batches have been written:
+    in_flight = threading.BoundedSemaphore(processes * BATCHES_IN_FLIGHT_PER_PROCESS)
+
+    def throttled_batches(dump):
+        for batch in read_batches(dump):
+            in_flight.acquire()
+            yield batch
+
+    started = time.time()
+    n_entities = n_stored = 0
+    with open_dump(dump_path) as dump, Pool(processes, init_worker, (classes,)) as pool:
+        for entity_rows, statement_rows, n_batch_entities in pool.imap(extract_batch, throttled_batches(dump)):
+            in_flight.release()
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?)', entity_rows)
+                connection.executemany('INSERT INTO statements VALUES (?, ?, ?, ?, ?)', statement_rows)
+            n_entities += n_batch_entities
+            n_stored += len(entity_rows)
+            if n_entities % (100 * BATCH_SIZE) < n_batch_entities:
+                log('{0} entities read, {1} stored ({2:.0f} entities/s)'.format(
+                    n_entities, n_stored, n_entities / (time.time() - started)))
+    log('Indexing {0} stored entities'.format(n_stored))
+    connection.executescript(INDEXES)
+    with connection:
+        connection.executemany('INSERT INTO metadata VALUES (?, ?)', [
+            ('dump', os.path.basename(dump_path)),
+            ('ingested_at', str(time.time())),
+            ('entities_read', str(n_entities)),
+            ('entities_stored', str(n_stored)),
+        ])
+    connection.execute('ANALYZE')
+    connection.close()
+    os.replace(temporary_path, store_path)
+    log('Finished in {0:.0f}s'.format(time.time() - started))
@@ -0,0 +1,315 @@
+'''A local SQLite store of television series, seasons and episodes
+
+The store is built from a Wikidata JSON dump by ingest-wikidata-dump
+(see dump_ingest.py). It holds only the statements that the queries in
+queries.py look at, so for any series it has, WikidataQueryService can
+answer those queries without going to the Wikidata Query Service.
+Results are in the SPARQL JSON results format, with the same bindings
+the query service would give (as of when the dump was made).
+'''
+
+import os
+import re
+import sqlite3
+import threading
+
+from episodes import ENTITY_PREFIX
+import queries
+
+EPISODE_STORE_PATH = os.environ.get('EPISODE_STORE_PATH')
+
+XSD_DECIMAL = 'http://www.w3.org/2001/XMLSchema#decimal'
+
+SCHEMA = '''
+CREATE TABLE entities (
+  id INTEGER PRIMARY KEY,
+  label TEXT,
+  is_series INTEGER NOT NULL,
+  is_season INTEGER NOT NULL,
+  is_episode INTEGER NOT NULL
+);
+-- One row per statement, or per P1545 (series ordinal) qualifier of a
+-- statement if it has more than one. best is 1 for statements with
+-- the best rank for their property, which are the only ones wdt:
+-- matches; ps: matches every statement.
+CREATE TABLE statements (
+  item INTEGER NOT NULL,
+  property TEXT NOT NULL,
+  value NOT NULL,
+  ordinal TEXT,
+  best INTEGER NOT NULL
+);
+CREATE TABLE metadata (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+'''
+
+INDEXES = '''
+CREATE INDEX statements_item ON statements (item, property);
+CREATE INDEX statements_value ON statements (property, value);
+'''
+
+# The properties whose statements are stored, for every series,
+# season and episode:
+STORED_PROPERTIES = ('P179', 'P4908', 'P155', 'P156', 'P2364', 'P1113', 'P2437', 'P361')
+
+MULTI_SEASON_SQL = '''
+SELECT e.id, e.label, s1.value, s1.ordinal, s3.ordinal, season.label, s2.ordinal,
+       pc.value, prev.value, next.value, eis.value, ts.value
+FROM statements s2
+JOIN entities e ON e.id = s2.item AND e.is_episode
+JOIN statements s1 ON s1.item = e.id AND s1.property = 'P4908'
+JOIN entities season ON season.id = s1.value AND season.is_season
+JOIN statements s3 ON s3.item = season.id AND s3.property = 'P179' AND s3.value = :series
+LEFT JOIN statements pc ON pc.item = e.id AND pc.property = 'P2364' AND pc.best
+LEFT JOIN statements prev ON prev.item = e.id AND prev.property = 'P155' AND prev.best
+LEFT JOIN statements next ON next.item = e.id AND next.property = 'P156' AND next.best
+LEFT JOIN statements eis ON eis.item = season.id AND eis.property = 'P1113' AND eis.best
+LEFT JOIN statements ts ON ts.item = :series AND ts.property = 'P2437' AND ts.best
+WHERE s2.property = 'P179' AND s2.value = :series
+ORDER BY CAST(s3.ordinal AS INTEGER), CAST(s2.ordinal AS INTEGER), pc.value
+'''
+
+SINGLE_SEASON_SQL = '''
+SELECT e.id, e.label, s.ordinal, pc.value, prev.value, next.value, eis.value, ts.value
+FROM statements s
+JOIN entities e ON e.id = s.item AND e.is_episode
+LEFT JOIN statements pc ON pc.item = e.id AND pc.property = 'P2364' AND pc.best
+LEFT JOIN statements prev ON prev.item = e.id AND prev.property = 'P155' AND prev.best
+LEFT JOIN statements next ON next.item = e.id AND next.property = 'P156' AND next.best
+LEFT JOIN statements eis ON eis.item = :series AND eis.property = 'P1113' AND eis.best
+LEFT JOIN statements ts ON ts.item = :series AND ts.property = 'P2437' AND ts.best
+WHERE s.property = 'P179' AND s.value = :series
+ORDER BY CAST(s.ordinal AS INTEGER), pc.value
+'''
+
+SEASONS_WITH_EPISODES_TOTALS_SQL = '''
+SELECT season.id, s.ordinal, eis.value
+FROM statements s
+JOIN entities season ON season.id = s.item AND season.is_season
+LEFT JOIN statements eis ON eis.item = season.id AND eis.property = 'P1113' AND eis.best
+WHERE s.property = 'P179' AND s.value = :series
+ORDER BY CAST(s.ordinal AS INTEGER)
+'''
+
+NUMBER_OF_SEASONS_SQL = '''
+SELECT value FROM statements WHERE item = :series AND property = 'P2437' AND best
+'''
+
+# The episodes that are 'part of' (P361) a season of the series, with
+# the ordinal of their own 'series' (P179) statement, if they have one:
+EPISODES_PART_OF_SEASONS_SQL = '''
+SELECT part.item, season.id, ser.item, ser.ordinal
+FROM statements s
+JOIN entities season ON season.id = s.item AND season.is_season
+JOIN statements part ON part.property = 'P361' AND part.value = season.id AND part.best
+LEFT JOIN statements ser ON ser.item = part.item AND ser.property = 'P179' AND ser.value = :series
+WHERE s.property = 'P179' AND s.value = :series
+ORDER BY CAST(s.ordinal AS INTEGER), CAST(ser.ordinal AS INTEGER)
+'''
+
+
+def template_pattern(template):
+    '''Return a regular expression matching a template from queries.py
+
+    It matches the template formatted with any item, after the
+    whitespace normalization WikidataQueryService does, and captures
+    the item's number.'''
+    placeholder = '\x00'
+    normalized = re.sub(r'\s+', ' ', template.format(item=placeholder)).strip()
+    return re.compile('^' + re.escape(normalized).replace(re.escape(placeholder), r'Q(\d+)') + '$')
+
+
+def uri(item_number):
+    return {'type': 'uri', 'value': '{0}Q{1}'.format(ENTITY_PREFIX, item_number)}
+
+
+def statement_uri(item_number):
+    return {'type': 'uri', 'value': '{0}statement/Q{1}-P179'.format(ENTITY_PREFIX, item_number)}
+
+
+def label_literal(item_number, label):
+    # The label service gives the Q-id, with no language, for items
+    # with no English label:
+    if label is None:
+        return {'type': 'literal', 'value': 'Q{0}'.format(item_number)}
+    return {'type': 'literal', 'value': label, 'xml:lang': 'en'}
+
+
+def literal(value):
+    return {'type': 'literal', 'value': str(value)}
+
+
+def decimal_literal(value):
+    return {'type': 'literal', 'value': str(value), 'datatype': XSD_DECIMAL}
+
+
+def optional(make_term, value):
+    return None if value is None else make_term(value)
+
+
+def binding(**values):
+    return {variable: value for variable, value in values.items() if value is not None}
+
+
+def select_result(variables, bindings):
+    return {'head': {'vars': variables}, 'results': {'bindings': list(bindings)}}
+
+
+class EpisodeStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.handlers = [
+            (template_pattern(queries.IS_ITEM_A_TV_SERIES_FMT), self.is_tv_series),
+            (template_pattern(queries.MULTI_SEASON_QUERY_FMT), self.multi_season_episodes),
+            (template_pattern(queries.SINGLE_SEASON_QUERY_FMT), self.single_season_episodes),
+            (template_pattern(queries.SEASONS_WITH_EPISODES_TOTALS_FMT), self.seasons_with_episodes_totals),
+            (template_pattern(queries.NUMBER_OF_SEASONS_FMT), self.number_of_seasons),
+            (template_pattern(queries.SERIES_DIAGNOSTICS_FMT), self.series_diagnostics),
+        ]
+
+    def connection(self):
+        '''Return this thread's connection to the store, or None if there's no store
+
+        The store is replaced (not updated) by each ingestion, so this
+        reconnects if the file has changed since the last call.'''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        identity = (stat.st_ino, stat.st_mtime)
+        if getattr(self.local, 'identity', None) != identity:
+            if getattr(self.local, 'connection', None) is not None:
+                self.local.connection.close()
+            self.local.connection = sqlite3.connect(
+                'file:{0}?mode=ro'.format(self.path), uri=True)
+            self.local.identity = identity
+        return self.local.connection
+
+    def answer(self, normalized_query):
+        '''Return the result of a query, or None if it can't be answered locally
+
+        Only the queries from queries.py that are about a single series
+        can be answered, and only if that series is in the store.'''
+        for pattern, handler in self.handlers:
+            match = pattern.match(normalized_query)
+            if match is not None:
+                break
+        else:
+            return None
+        connection = self.connection()
+        if connection is None:
+            return None
+        series = int(match.group(1))
+        row = connection.execute(
+            'SELECT label, is_series FROM entities WHERE id = ?', (series,)).fetchone()
+        if row is None:
+            return None
+        return handler(connection, series, row)
+
+    def is_tv_series(self, connection, series, row):
+        return {'head': {}, 'boolean': bool(row[1])}
+
+    def multi_season_episodes(self, connection, series, row):
+        series_label = label_literal(series, row[0])
+        return select_result(
+            ['episodeLabel', 'episode', 'series', 'seriesLabel', 'season', 'numberInSeason',
+             'seasonNumber', 'seasonLabel', 'episodeNumber', 'productionCode',
+             'previousEpisode', 'nextEpisode', 'episodesInSeason', 'totalSeasons'],
+            (
+                binding(
+                    episodeLabel=label_literal(episode, episode_label),
+                    episode=uri(episode),
+                    series=uri(series),
+                    seriesLabel=series_label,
+                    season=uri(season),
+                    numberInSeason=optional(literal, number_in_season),
+                    seasonNumber=optional(literal, season_number),
+                    seasonLabel=label_literal(season, season_label),
+                    episodeNumber=optional(literal, episode_number),
+                    productionCode=optional(literal, production_code),
+                    previousEpisode=optional(uri, previous_episode),
+                    nextEpisode=optional(uri, next_episode),
+                    episodesInSeason=optional(decimal_literal, episodes_in_season),
+                    totalSeasons=optional(decimal_literal, total_seasons),
+                )
+                for (episode, episode_label, season, number_in_season, season_number,
+                     season_label, episode_number, production_code, previous_episode,
+                     next_episode, episodes_in_season, total_seasons)
+                in connection.execute(MULTI_SEASON_SQL, {'series': series})
+            )
+        )
+
+    def single_season_episodes(self, connection, series, row):
+        series_label = label_literal(series, row[0])
+        return select_result(
+            ['episodeLabel', 'episode', 'series', 'seriesLabel', 'episodeNumber',
+             'productionCode', 'previousEpisode', 'nextEpisode', 'episodesInSeason',
+             'totalSeasons'],
+            (
+                binding(
+                    episodeLabel=label_literal(episode, episode_label),
+                    episode=uri(episode),
+                    series=uri(series),
+                    seriesLabel=series_label,
+                    episodeNumber=optional(literal, episode_number),
+                    productionCode=optional(literal, production_code),
+                    previousEpisode=optional(uri, previous_episode),
+                    nextEpisode=optional(uri, next_episode),
+                    episodesInSeason=optional(decimal_literal, episodes_in_season),
+                    totalSeasons=optional(decimal_literal, total_seasons),
+                )
+                for (episode, episode_label, episode_number, production_code,
+                     previous_episode, next_episode, episodes_in_season, total_seasons)
+                in connection.execute(SINGLE_SEASON_SQL, {'series': series})
+            )
+        )
+
+    def seasons_with_episodes_totals(self, connection, series, row):
+        return select_result(
+            ['season', 'seasonNumber', 'episodesInSeason'],
+            (
+                binding(
+                    season=uri(season),
+                    seasonNumber=optional(literal, season_number),
+                    episodesInSeason=optional(decimal_literal, episodes_in_season),
+                )
+                for season, season_number, episodes_in_season
+                in connection.execute(SEASONS_WITH_EPISODES_TOTALS_SQL, {'series': series})
+            )
+        )
+
+    def number_of_seasons(self, connection, series, row):
+        return select_result(
+            ['numberOfSeasons'],
+            (
+                {'numberOfSeasons': decimal_literal(number_of_seasons)}
+                for number_of_seasons, in connection.execute(NUMBER_OF_SEASONS_SQL, {'series': series})
+            )
+        )
+
+    def series_diagnostics(self, connection, series, row):
+        # The store doesn't keep statement IDs, so the episodes' 'series'
+        # statements are given made-up (but distinct) URIs:
+        episode_bindings = [
+            binding(
+                episode=uri(episode),
+                episodeSeason=uri(season),
+                seriesStatement=optional(statement_uri, series_statement_item),
+                episodeNumber=optional(literal, episode_number),
+            )
+            for episode, season, series_statement_item, episode_number
+            in connection.execute(EPISODES_PART_OF_SEASONS_SQL, {'series': series})
+        ]
+        bindings = self.number_of_seasons(connection, series, row)['results']['bindings']
+        bindings.extend(self.seasons_with_episodes_totals(connection, series, row)['results']['bindings'])
+        bindings.extend(episode_bindings)
+        bindings.append({'seriesLabel': label_literal(series, row[0])})
+        return select_result(
+            ['numberOfSeasons', 'season', 'seasonNumber', 'episodesInSeason',
+             'episode', 'episodeSeason', 'episodeNumber', 'seriesStatement', 'seriesLabel'],
+            bindings
+        )
@@ -1,9 +1,31 @@
 from itertools import groupby
-import re
+import sys
+
+
+ENTITY_PREFIX = 'http://www.wikidata.org/entity/'
 
 
 def id_from_item_url(url):
-    return re.sub(r'^http://www.wikidata.org/entity/', '', url)
+    if url.startswith(ENTITY_PREFIX):
+        return url[len(ENTITY_PREFIX):]
+    return url
+
+
+def compact_id_from_item_url(url):
+    '''Return the number of an item's Q-id from its URL, or its ID if it's not an item
+
+    Episodes keep these rather than the Q-id strings, since an int
+    takes less memory and is quicker to hash.'''
+    item_id = id_from_item_url(url)
+    if item_id[:1] == 'Q' and item_id[1:].isdigit():
+        return int(item_id[1:])
+    return sys.intern(item_id)
+
+
+def item_from_compact_id(compact_id):
+    if compact_id is None or isinstance(compact_id, str):
+        return compact_id
+    return 'Q{0}'.format(compact_id)
 
 
 def int_if_present(binding, key):
@@ -24,36 +46,88 @@ def id_if_present(binding, key):
     return None
 
 
+def compact_id_if_present(binding, key):
+    if key in binding:
+        return compact_id_from_item_url(binding[key]['value'])
+    return None
+
+
 class Episode(object):
+    # There can be tens of thousands of these for a long-running
+    # series, so they have no __dict__, the strings that are the same
+    # for every episode in a series or season are interned, and items
+    # are held as compact IDs (see compact_id_from_item_url) with
+    # properties to get their Q-ids:
+    __slots__ = (
+        'name', 'series_name', 'item_id', 'series_item_id', 'season_item_id',
+        'season_number', 'season_label', 'episode_number_in_season',
+        'episode_number', 'production_code', 'previous_episode_item_id',
+        'previous_episode', 'next_episode_item_id', 'next_episode',
+        'episodes_in_season', 'total_seasons',
+    )
+
     def __init__(self, binding):
         self.name = binding['episodeLabel']['value']
-        self.series_name = binding['seriesLabel']['value']
-        self.item = id_from_item_url(binding['episode']['value'])
-        self.series_item = id_from_item_url(binding['series']['value'])
+        self.series_name = sys.intern(binding['seriesLabel']['value'])
+        self.item_id = compact_id_from_item_url(binding['episode']['value'])
+        self.series_item_id = compact_id_from_item_url(binding['series']['value'])
         if 'season' in binding:
-            self.season_item = id_from_item_url(binding['season']['value'])
+            self.season_item_id = compact_id_from_item_url(binding['season']['value'])
             self.season_number = int_if_present(binding, 'seasonNumber')
-            self.season_label = binding['seasonLabel']['value']
+            self.season_label = sys.intern(binding['seasonLabel']['value'])
         else:
-            self.season_item = None
+            self.season_item_id = None
             self.season_number = 1
             self.season_label = None
         self.episode_number_in_season = str_if_present(binding, 'numberInSeason')
         self.episode_number = str_if_present(binding, 'episodeNumber')
         self.production_code = str_if_present(binding, 'productionCode')
-        self.previous_episode_item = id_if_present(binding, 'previousEpisode')
+        self.previous_episode_item_id = compact_id_if_present(binding, 'previousEpisode')
         self.previous_episode = None
-        self.next_episode_item = id_if_present(binding, 'nextEpisode')
+        self.next_episode_item_id = compact_id_if_present(binding, 'nextEpisode')
         self.next_episode = None
         self.episodes_in_season = int_if_present(binding, 'episodesInSeason')
         self.total_seasons = int_if_present(binding, 'totalSeasons')
 
+    def __getstate__(self):
+        # Drop the links to neighbouring episodes so that pickling a
+        # long chain of episodes doesn't recurse once per episode;
+        # link_episodes restores them after unpickling.
+        state = {slot: getattr(self, slot) for slot in self.__slots__}
+        state['previous_episode'] = None
+        state['next_episode'] = None
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
     def __eq__(self, other):
-        return self.item == other.item
+        return self.item_id == other.item_id
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    @property
+    def item(self):
+        return item_from_compact_id(self.item_id)
+
+    @property
+    def series_item(self):
+        return item_from_compact_id(self.series_item_id)
+
+    @property
+    def season_item(self):
+        return item_from_compact_id(self.season_item_id)
+
+    @property
+    def previous_episode_item(self):
+        return item_from_compact_id(self.previous_episode_item_id)
+
+    @property
+    def next_episode_item(self):
+        return item_from_compact_id(self.next_episode_item_id)
+
     @property
     def label_with_item(self):
         if self.item == self.name:
@@ -62,44 +136,96 @@ class Episode(object):
             return '{0} ({1})'.format(self.name, self.item)
 
 
-def group_and_order_episodes(episodes):
-    id_to_episode = {}
+def index_episodes(all_episodes):
+    return {episode.item_id: episode for episode in all_episodes}
+
+
+def link_episodes(all_episodes):
+    '''Set the previous_episode and next_episode links of each of all_episodes'''
+    item_id_to_episode = index_episodes(all_episodes)
+    for episode in all_episodes:
+        episode.previous_episode = item_id_to_episode.get(episode.previous_episode_item_id)
+        episode.next_episode = item_id_to_episode.get(episode.next_episode_item_id)
+
+
+def parse_episodes(result_bindings):
+    return [Episode(b) for b in result_bindings]
+
+
+class EpisodeOrdering(object):
+    '''The episodes of a series in order and grouped by season, with any problems found
+
+    This is built once by order_episodes and then used for both the
+    table of episodes and the problem report.'''
+
+    def __init__(self, episodes, ordered_episodes, ordered_by_links, seasons,
+                 first_episodes, last_episodes, unlinked_episodes, report_items):
+        # The episodes in the order the query returned them:
+        self.episodes = episodes
+        # The episodes in the order of their 'follows' / 'followed by'
+        # links if they were consistent (see ordered_by_links), or
+        # otherwise the same as episodes:
+        self.ordered_episodes = ordered_episodes
+        self.ordered_by_links = ordered_by_links
+        # A list of ((season_item, season_number, season_label), episodes)
+        # tuples, for each run of ordered_episodes in the same season:
+        self.seasons = seasons
+        self.first_episodes = first_episodes
+        self.last_episodes = last_episodes
+        self.unlinked_episodes = unlinked_episodes
+        self.report_items = report_items
+
+
+def order_episodes(episodes):
+    '''Link, check and order episodes, returning an EpisodeOrdering
+
+    This indexes the episodes, then makes a single pass over them to
+    link each to its neighbours and check that the 'follows' /
+    'followed by' relationships are consistent, so it takes linear
+    time however the links are broken.'''
+    id_to_episode = index_episodes(episodes)
     first_episodes = []
     last_episodes = []
-    for episode in episodes:
-        id_to_episode[episode.item] = episode
     # Check that the previous and next episodes are consistent:
     unlinked_episodes = []
     problems = []
     for episode in episodes:
-        if not episode.previous_episode_item and not episode.next_episode_item:
+        previous_episode = id_to_episode.get(episode.previous_episode_item_id)
+        next_episode = id_to_episode.get(episode.next_episode_item_id)
+        episode.previous_episode = previous_episode
+        episode.next_episode = next_episode
+        if episode.previous_episode_item_id is None and episode.next_episode_item_id is None:
             fmt = 'Episode {item_id} has no previous or next episode'
             problems.append(fmt.format(item_id=episode.label_with_item))
             unlinked_episodes.append(episode)
-        if episode.previous_episode:
-            if episode.previous_episode.next_episode:
-                if episode.previous_episode.next_episode != episode:
+        if previous_episode:
+            # Look the neighbour's own link up in the index, since it
+            # may not have been linked yet in this pass:
+            previous_next_episode = id_to_episode.get(previous_episode.next_episode_item_id)
+            if previous_next_episode:
+                if previous_next_episode != episode:
                     fmt = '{0} follows {1}, but {1} followed by {2}'
                     problems.append(fmt.format(
                         episode.label_with_item,
-                        episode.previous_episode.label_with_item,
-                        episode.previous_episode.next_episode.label_with_item))
-        if episode.next_episode:
-            if episode.next_episode.previous_episode:
-                if episode.next_episode.previous_episode != episode:
+                        previous_episode.label_with_item,
+                        previous_next_episode.label_with_item))
+        if next_episode:
+            next_previous_episode = id_to_episode.get(next_episode.previous_episode_item_id)
+            if next_previous_episode:
+                if next_previous_episode != episode:
                     fmt = '{0} followed by {1}, but {1} follows {2}'
                     problems.append(fmt.format(
                         episode.label_with_item,
-                        episode.next_episode.label_with_item,
-                        episode.next_episode.previous_episode.label_with_item))
+                        next_episode.label_with_item,
+                        next_previous_episode.label_with_item))
             else:
                 fmt = '{0} followed by {1}, but {1} follows nothing'
                 problems.append(fmt.format(
                     episode.label_with_item,
-                    episode.next_episode.label_with_item))
-        if episode.next_episode and not episode.previous_episode:
+                    next_episode.label_with_item))
+        if next_episode and not previous_episode:
             first_episodes.append(episode)
-        if episode.previous_episode and not episode.next_episode:
+        if previous_episode and not next_episode:
             last_episodes.append(episode)
     first_or_last_problems = []
     if len(first_episodes) == 0:
@@ -119,12 +245,46 @@ def group_and_order_episodes(episodes):
     # If there are no unlinked episodes, 1 first episode and no
     # 'follows' / 'followed by' consistency problems, then we can
     # order by the 'follows' / 'followed by' relationships:
+    ordered_episodes = episodes
+    ordered_by_links = False
     if len(first_episodes) == 1 and len(unlinked_episodes) == 0 \
        and len(problems) == 0:
-        episodes = []
-        current_episode = next(iter(first_episodes))
-        while current_episode:
-            episodes.append(current_episode)
+        chain = []
+        visited = set()
+        current_episode = first_episodes[0]
+        while current_episode and current_episode.item_id not in visited:
+            visited.add(current_episode.item_id)
+            chain.append(current_episode)
             current_episode = current_episode.next_episode
+        if len(chain) == len(id_to_episode):
+            ordered_episodes = chain
+            ordered_by_links = True
+        elif len(last_episodes) == 1:
+            # The links are consistent and there's just one first and
+            # last episode, but some episodes aren't reachable from the
+            # first one, so they must form a cycle. (If there were more
+            # than one last episode, the chain is broken, which has
+            # already been reported.)
+            unreachable = [e for e in id_to_episode.values() if e.item_id not in visited]
+            fmt = '''Some episodes couldn\'t be reached by following \'followed by\'
+               from the first episode, so they must form a cycle: {0}'''
+            problems.append(fmt.format(', '.join(e.label_with_item for e in unreachable)))
+    seasons = [
+        (
+            (item_from_compact_id(season_item_id), season_number, season_label),
+            list(season_episodes)
+        )
+        for (season_item_id, season_number, season_label), season_episodes in groupby(
+            ordered_episodes, lambda e: (e.season_item_id, e.season_number, e.season_label))
+    ]
     report_items = [(False, problem) for problem in first_or_last_problems + problems]
-    return groupby(episodes, lambda e: (e.season_item, e.season_number, e.season_label)), report_items
+    return EpisodeOrdering(
+        episodes=episodes,
+        ordered_episodes=ordered_episodes,
+        ordered_by_links=ordered_by_links,
+        seasons=seasons,
+        first_episodes=first_episodes,
+        last_episodes=last_episodes,
+        unlinked_episodes=unlinked_episodes,
+        report_items=report_items,
+    )
@@ -0,0 +1,17 @@
+# Settings for gunicorn, which serves the web process (see the Procfile)
+#
+# By default each worker is a gevent worker, which serves many requests
+# at once on green threads: the standard library's sockets, threads and
+# sleeps are patched so that a request waiting on the Wikidata Query
+# Service or Redis lets the worker get on with other requests, rather
+# than tying it up as a sync worker would. All of the code, including
+# the thread pools in wikidata.py and cache.py, runs unchanged, with
+# its threads as green threads. Set WEB_WORKER_CLASS=sync to go back to
+# sync workers.
+
+from os import environ
+
+worker_class = environ.get('WEB_WORKER_CLASS', 'gevent')
+# The number of requests each gevent worker will serve at once:
+worker_connections = int(environ.get('WEB_WORKER_CONNECTIONS', '1000'))
+# WEB_CONCURRENCY, which Heroku sets, is the number of workers.
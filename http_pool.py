@@ -0,0 +1,218 @@
+'''A pool of persistent HTTP connections to a single server
+
+SPARQLWrapper opens a new connection (and for HTTPS, does a new TLS
+handshake) for every query. ConnectionPool keeps connections open
+between requests and reuses them, asks for gzipped responses and
+decompresses them as they're read, and retries requests that fail
+in ways that might not happen next time, waiting as long as the
+server asks to with Retry-After. A request that times out once it's
+been sent isn't retried, since the server may well still be working
+on it.
+'''
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import http.client
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import zlib
+
+# Responses with these statuses are retried. Not 500, which is what
+# the Wikidata Query Service gives when a query runs into its timeout:
+# retrying that would only use up another minute of its time, which
+# its usage policy asks clients not to do.
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+# Nor is any response whose body says a query timed out:
+TIMEOUT_ERROR_MARKER = b'java.util.concurrent.TimeoutException'
+
+READ_SIZE = 64 * 1024
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, reason, body):
+        super().__init__('HTTP {0} {1}: {2}'.format(status, reason, body[:500]))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+def retry_after_seconds(value):
+    '''Return the number of seconds a Retry-After header value asks for, or None'''
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class PooledResponse(object):
+    '''A response whose body is read and decompressed a piece at a time
+
+    Iterating over it gives the lines of the body. It must be closed,
+    which returns the connection to the pool if the whole body was
+    read.'''
+
+    def __init__(self, pool, connection, response):
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = None
+
+    def read_chunks(self):
+        while True:
+            data = self.response.read(READ_SIZE)
+            if not data:
+                break
+            if self.decompressor is not None:
+                data = self.decompressor.decompress(data)
+            if data:
+                yield data
+        if self.decompressor is not None:
+            data = self.decompressor.flush()
+            if data:
+                yield data
+
+    def read(self):
+        return b''.join(self.read_chunks())
+
+    def __iter__(self):
+        remainder = b''
+        for chunk in self.read_chunks():
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if remainder:
+            yield remainder
+
+    def close(self):
+        if self.connection is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+
+
+class ConnectionPool(object):
+
+    def __init__(self, url, max_idle_connections=8, connect_timeout=5, read_timeout=65,
+                 max_attempts=3, backoff_base=1, max_retry_after=60, on_event=None):
+        '''Create a pool of connections to the server of url
+
+        on_event, if given, is called with 'connection-opened' or
+        'connection-reused' for every request sent, and 'retry' for
+        every request that's retried.'''
+        parts = urlsplit(url)
+        self.connection_class = (
+            http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        self.max_idle_connections = max_idle_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.max_retry_after = max_retry_after
+        self.on_event = on_event or (lambda event: None)
+        self.idle_connections = []
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        connection = self.connection_class(self.host, self.port, timeout=self.connect_timeout)
+        try:
+            connection.connect()
+        except OSError as e:
+            # Nothing's been sent yet, so this is always worth retrying
+            # (see request), even if it was a timeout:
+            raise ConnectionError('Could not connect to {0}: {1}'.format(self.host, e)) from e
+        connection.sock.settimeout(self.read_timeout)
+        self.on_event('connection-opened')
+        return connection
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle_connections) < self.max_idle_connections:
+                self.idle_connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            connections, self.idle_connections = self.idle_connections, []
+        for connection in connections:
+            connection.close()
+
+    def send(self, method, url, body, headers):
+        with self.lock:
+            connection = self.idle_connections.pop() if self.idle_connections else None
+        if connection is not None:
+            try:
+                connection.request(method, url, body, headers)
+                self.on_event('connection-reused')
+                return PooledResponse(self, connection, connection.getresponse())
+            except (ConnectionError, http.client.HTTPException):
+                # The server probably closed the connection while it
+                # was idle, so try again with a new one:
+                connection.close()
+        connection = self.new_connection()
+        try:
+            connection.request(method, url, body, headers)
+            return PooledResponse(self, connection, connection.getresponse())
+        except Exception:
+            connection.close()
+            raise
+
+    def backoff(self, attempt):
+        # "Full jitter", so that clients that failed together don't
+        # all retry together:
+        return random.uniform(0, self.backoff_base * 2 ** (attempt - 1))
+
+    def request(self, method, url, body=None, headers=None):
+        '''Send a request, returning a PooledResponse with a successful status
+
+        Raises HTTPError for an unsuccessful status once there are no
+        attempts left, or straight away if it's not worth retrying.
+        Only failures to connect and connections being reset are
+        retried: any other error, such as the response timing out, is
+        raised straight away.'''
+        headers = dict(headers or {}, **{'Accept-Encoding': 'gzip'})
+        attempt = 1
+        while True:
+            try:
+                response = self.send(method, url, body, headers)
+            except ConnectionError:
+                if attempt >= self.max_attempts:
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if response.status < 400:
+                    return response
+                response_body = response.read()
+                response.close()
+                retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+                retryable = response.status in RETRY_STATUSES and TIMEOUT_ERROR_MARKER not in response_body
+                wait_too_long = retry_after is not None and retry_after > self.max_retry_after
+                if not retryable or attempt >= self.max_attempts or wait_too_long:
+                    raise HTTPError(
+                        response.status, response.reason, response_body.decode('utf-8', 'replace'))
+                delay = self.backoff(attempt) if retry_after is None else retry_after
+            self.on_event('retry')
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,131 @@
+'''An in-process cache of decoded values, in front of Redis
+
+Each worker process keeps the values it has most recently read from
+(or written to) Redis, already decoded, so that hot keys like the
+homepage's example series don't need a Redis round trip and a decode
+on every request. Entries expire after a TTL (and are dropped when
+next looked up after that), and the least recently used are evicted
+when the total size of what's held goes over LOCAL_CACHE_MAX_BYTES.
+Each entry's size is that of its encoded form in Redis, which the
+caller already knows, since measuring the decoded values would take
+longer than decoding them.
+
+When a worker purges a key it publishes the key on a Redis channel;
+every worker listens on that channel and drops the key from its own
+local cache, so purges still take effect everywhere.
+'''
+
+from collections import OrderedDict
+from os import environ, getpid
+import threading
+import time
+
+# This counts encoded sizes, and the decoded values held take several
+# times as much memory:
+LOCAL_CACHE_MAX_BYTES = int(environ.get('LOCAL_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+# Even if a purge message is missed, no entry outlives this:
+LOCAL_CACHE_MAX_TTL = int(environ.get('LOCAL_CACHE_MAX_TTL', str(5 * 60)))
+INVALIDATION_RETRY_INTERVAL = 5
+
+
+class LRUCache(object):
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # Maps each key to a tuple of (value, size, expires_at), from
+        # least to most recently used:
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if time.time() >= expires_at:
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl, size):
+        '''Hold value for key for ttl seconds, counting it as size bytes'''
+        ttl = min(ttl, LOCAL_CACHE_MAX_TTL)
+        if ttl <= 0:
+            self.delete(key)
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size, time.time() + ttl)
+            self.total_bytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def _evict(self):
+        # Expired entries are only dropped when they're looked up, or
+        # when they reach the least recently used end:
+        while self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+
+class InvalidationListener(object):
+    '''Drops keys from a local cache when they're published on a Redis channel'''
+
+    def __init__(self, redis_api, channel, local_cache):
+        self.redis_api = redis_api
+        self.channel = channel
+        self.local_cache = local_cache
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        # Started lazily, and again in any forked child (e.g. each
+        # gunicorn worker), since threads don't survive a fork:
+        if self.pid == getpid():
+            return
+        with self.lock:
+            if self.pid == getpid():
+                return
+            self.local_cache.clear()
+            thread = threading.Thread(target=self._listen, name='local-cache-invalidation')
+            thread.daemon = True
+            thread.start()
+            self.pid = getpid()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis_api.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    key = message['data']
+                    if isinstance(key, bytes):
+                        key = key.decode('utf-8')
+                    self.local_cache.delete(key)
+            except Exception:
+                # We may have missed invalidations while disconnected,
+                # so don't trust anything we're holding:
+                self.local_cache.clear()
+                time.sleep(INVALIDATION_RETRY_INTERVAL)
+
+    def publish(self, key):
+        self.local_cache.delete(key)
+        self.redis_api.publish(self.channel, key)
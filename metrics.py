@@ -0,0 +1,190 @@
+'''Histograms of how SPARQL queries performed, for /metrics
+
+Every query run by a WikidataQueryService records how long it took,
+where its result came from, how many rows it had and how big the
+result is once encoded for the cache (see wikidata.WikidataQuery).
+Those are added to histograms labelled by which of the templates in
+queries.py the query was made from. The histograms are kept in Redis,
+so that they cover every worker process, and rendered in the
+Prometheus text format by render_metrics.
+
+The bucket counts are stored per bucket (not cumulatively, as
+Prometheus wants them) so that recording an observation only needs
+increments, sent in one pipeline; render_metrics adds them up.
+'''
+
+from collections import OrderedDict
+import re
+
+from cache import redis_api, redis_key
+import queries
+
+METRIC_PREFIX = 'wikidata_tv_'
+
+QUERY_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+QUERY_BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def template_pattern(template):
+    '''Make a regular expression matching queries made from template
+
+    Both are compared with runs of whitespace collapsed, as the
+    queries are when they're cached. Only templates with doubled
+    braces are treated as format strings; the others (e.g.
+    queries.ALL_TV_SERIES) are used as they are.'''
+    template = re.sub(r'\s+', ' ', template).strip()
+    if '{{' not in template:
+        return re.compile(re.escape(template) + r'\Z')
+    parts = []
+    for part in re.split(r'(\{\{|\}\}|\{[^{}]*\})', template):
+        if part == '{{':
+            parts.append(re.escape('{'))
+        elif part == '}}':
+            parts.append(re.escape('}'))
+        elif part.startswith('{'):
+            parts.append('.*?')
+        else:
+            parts.append(re.escape(part))
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+
+QUERY_TEMPLATE_PATTERNS = [
+    (re.sub(r'_FMT$', '', name).lower().replace('_', '-'), template_pattern(template))
+    for name, template in sorted(vars(queries).items())
+    if name.isupper() and isinstance(template, str)
+]
+
+
+def query_template_name(query):
+    '''Return the name of the template in queries.py that query was made from
+
+    e.g. 'multi-season-query' for a query made from
+    queries.MULTI_SEASON_QUERY_FMT, or 'other' if none match.'''
+    normalized_query = re.sub(r'\s+', ' ', query).strip()
+    for name, pattern in QUERY_TEMPLATE_PATTERNS:
+        if pattern.match(normalized_query):
+            return name
+    return 'other'
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    return ','.join(
+        '{0}="{1}"'.format(name, escape_label_value(value))
+        for name, value in labels
+    )
+
+
+def format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+class Histogram(object):
+
+    def __init__(self, name, description, buckets):
+        self.name = METRIC_PREFIX + name
+        self.description = description
+        self.buckets = buckets
+        self.key = 'metrics:{0}'.format(name)
+
+    def bucket_for(self, value):
+        for bucket in self.buckets:
+            if value <= bucket:
+                return format_number(bucket)
+        return '+Inf'
+
+    def observe(self, pipeline, labels, value):
+        '''Add an observation of value to pipeline's commands
+
+        labels is a sequence of (name, value) pairs.'''
+        labels = format_labels(labels)
+        key = redis_key(self.key)
+        pipeline.hincrby(key, '{0}|{1}'.format(labels, self.bucket_for(value)), 1)
+        pipeline.hincrbyfloat(key, '{0}|sum'.format(labels), value)
+        pipeline.hincrby(key, '{0}|count'.format(labels), 1)
+
+    def render(self, fields):
+        '''Return the lines of the Prometheus text format for this histogram
+
+        fields is the Redis hash of the histogram, as stored by
+        observe.'''
+        series = OrderedDict()
+        for field, value in sorted(fields.items()):
+            if isinstance(field, bytes):
+                field, value = field.decode('utf-8'), value.decode('utf-8')
+            labels, _, suffix = field.rpartition('|')
+            series.setdefault(labels, {})[suffix] = value
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.description),
+            '# TYPE {0} histogram'.format(self.name),
+        ]
+        for labels, values in series.items():
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bucket in [format_number(b) for b in self.buckets] + ['+Inf']:
+                cumulative += int(values.get(bucket, 0))
+                lines.append('{0}_bucket{{{1}{2}le="{3}"}} {4}'.format(
+                    self.name, labels, separator, bucket, cumulative))
+            lines.append('{0}_sum{{{1}}} {2}'.format(self.name, labels, values.get('sum', 0)))
+            lines.append('{0}_count{{{1}}} {2}'.format(self.name, labels, values.get('count', 0)))
+        return lines
+
+
+QUERY_SECONDS = Histogram(
+    'query_duration_seconds',
+    'Time taken to get the result of a SPARQL query, including from the cache',
+    QUERY_SECONDS_BUCKETS)
+QUERY_ROWS = Histogram(
+    'query_result_rows',
+    'Number of bindings in the results of SPARQL queries',
+    QUERY_ROWS_BUCKETS)
+QUERY_BYTES = Histogram(
+    'query_result_bytes',
+    'Size of the results of SPARQL queries, as encoded for the cache',
+    QUERY_BYTES_BUCKETS)
+
+HISTOGRAMS = (QUERY_SECONDS, QUERY_ROWS, QUERY_BYTES)
+
+
+def record_query(wikidata_query):
+    '''Add a finished WikidataQuery to the histograms'''
+    template = ('template', wikidata_query.template)
+    pipeline = redis_api.pipeline(transaction=False)
+    QUERY_SECONDS.observe(
+        pipeline, [template, ('outcome', wikidata_query.outcome)], wikidata_query.seconds)
+    if wikidata_query.rows is not None:
+        QUERY_ROWS.observe(pipeline, [template], wikidata_query.rows)
+    if wikidata_query.size is not None:
+        QUERY_BYTES.observe(pipeline, [template], wikidata_query.size)
+    pipeline.execute()
+
+
+def render_metrics():
+    '''Return the histograms, and the stats:* counters, in the Prometheus text format'''
+    pipeline = redis_api.pipeline(transaction=False)
+    for histogram in HISTOGRAMS:
+        pipeline.hgetall(redis_key(histogram.key))
+    lines = []
+    for histogram, fields in zip(HISTOGRAMS, pipeline.execute()):
+        lines.extend(histogram.render(fields))
+    # The counts of various events that are kept elsewhere with
+    # redis_incr, e.g. stats:queries-coalesced:
+    stats_prefix = redis_key('stats:')
+    stats_keys = sorted(redis_api.scan_iter(match=stats_prefix + '*'))
+    if stats_keys:
+        name = METRIC_PREFIX + 'events_total'
+        lines.append('# HELP {0} Counts of cache and query service events'.format(name))
+        lines.append('# TYPE {0} counter'.format(name))
+        for key, value in zip(stats_keys, redis_api.mget(stats_keys)):
+            if value is None:
+                continue
+            event = key.decode('utf-8')[len(stats_prefix):]
+            lines.append('{0}{{{1}}} {2}'.format(
+                name, format_labels([('event', event)]), int(value)))
+    return '\n'.join(lines) + '\n'
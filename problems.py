@@ -1,18 +1,11 @@
-from itertools import groupby
-
-from episodes import group_and_order_episodes, id_from_item_url
+from episodes import id_from_item_url
 import queries
 
 
-def report(episodes):
-    grouped_episodes_iter, report_items = group_and_order_episodes(episodes)
-    # Just make this non-lazy to avoid confusion when items are
-    # consumed and you can't get them back:
-    grouped = [
-        (season_tuple, list(episodes_group))
-        for season_tuple, episodes_group in grouped_episodes_iter
-    ]
-    for season_tuple, episodes_group in grouped:
+def report(ordering):
+    '''Return report items for the episodes in an episodes.EpisodeOrdering'''
+    report_items = list(ordering.report_items)
+    for season_tuple, episodes_group in ordering.seasons:
         season_item, season_number, season_label = season_tuple
         if episodes_group:
             # Then there are some episodes in that season:
@@ -40,7 +33,7 @@ def report(episodes):
             fmt = 'There were no episodes at all found in season {season_item}!'
             report_items.append((False, fmt.format(season_item=season_item)))
     episodes_without_an_episode_number = [
-        episode for episode in episodes
+        episode for episode in ordering.episodes
         if not episode.episode_number
     ]
     if len(episodes_without_an_episode_number):
@@ -56,17 +49,48 @@ def report(episodes):
     return report_items
 
 
-def report_extra_queries(query_service, series_item):
-    report_items = []
-    # First check if it has a number of seasons property:
+def fetch_diagnostics(query_service, series_item):
+    '''Return the label of series_item and the report items from its diagnostic query
+
+    This runs the single queries.SERIES_DIAGNOSTICS_FMT query, which
+    gets everything report_extra_queries looks at, and the label for
+    the page, in one round trip.'''
     results = query_service.run_query(
-        queries.NUMBER_OF_SEASONS_FMT.format(item=series_item),
-        'Checking if {0} has a \'number of seasons\' property'.format(series_item)
+        queries.SERIES_DIAGNOSTICS_FMT.format(item=series_item),
+        'Checking the seasons of {0} and the episodes that are part of them'.format(series_item)
     )
-    values = [
-        b['numberOfSeasons']['value'] for b in
-        results['results']['bindings']
-    ]
+    series_name = series_item
+    number_of_seasons_values = []
+    seasons = []
+    season_episodes = []
+    for b in results['results']['bindings']:
+        values = {k: v['value'] for k, v in b.items()}
+        if 'seriesLabel' in values:
+            series_name = values['seriesLabel']
+        elif 'numberOfSeasons' in values:
+            number_of_seasons_values.append(values['numberOfSeasons'])
+        elif 'episode' in values:
+            values['season'] = values.pop('episodeSeason')
+            season_episodes.append(values)
+        elif 'season' in values:
+            seasons.append(values)
+    return series_name, diagnostics_report(series_item, number_of_seasons_values, seasons, season_episodes)
+
+
+def report_extra_queries(query_service, series_item):
+    _, report_items = fetch_diagnostics(query_service, series_item)
+    return report_items
+
+
+def diagnostics_report(series_item, number_of_seasons_values, seasons, season_episodes):
+    '''Return report items about the seasons of series_item and the episodes that are part of them
+
+    number_of_seasons_values are the values of its 'number of seasons'
+    (P2437), seasons a dict for each of its seasons and
+    season_episodes a dict for each episode that's 'part of' (P361)
+    one of those seasons, as found by queries.SERIES_DIAGNOSTICS_FMT.'''
+    report_items = []
+    values = number_of_seasons_values
     values_len = len(values)
     if values_len > 1:
         report_items.append(
@@ -93,15 +117,8 @@ def report_extra_queries(query_service, series_item):
             )
         )
         number_of_seasons = None
-    # Now find all the seasons, with option extra properties:
-    results = query_service.run_query(
-        queries.SEASONS_WITH_EPISODES_TOTALS_FMT.format(item=series_item),
-        'Finding all seasons of {0}'.format(series_item)
-    )
-    values = [
-        {k: v['value'] for k, v in b.items()}
-        for b in results['results']['bindings']
-    ]
+    # Now look at all the seasons, with option extra properties:
+    values = seasons
     if number_of_seasons is not None:
         if number_of_seasons == len(values):
             report_items.append(
@@ -143,23 +160,13 @@ def report_extra_queries(query_service, series_item):
         else:
             fmt = "No 'number of episodes' (P1113) statement for season {0}"
             report_items.append((False, fmt.format(season_item)))
-    all_seasons = ['wd:' + id_from_item_url(season['season']) for season in values]
-    results = query_service.run_query(queries.EPISODES_FROM_SEASON_AND_SERIES_FMT.format(
-        item=series_item,
-        seasons=' '.join(all_seasons)),
-        'Finding the episodes directly from season items'
-    )
-    values = [
-        {k: v['value'] for k, v in b.items()}
-        for b in results['results']['bindings']
-    ]
+    values = season_episodes
     if values:
-        # Group these episodes by season so we can compare the counts:
-        grouped_by_season = {
-            season: list(results)
-            for season, results
-            in groupby(values, lambda v: id_from_item_url(v['season']))
-        }
+        # Group these episodes by season so we can compare the counts
+        # (indexing them, since they're not ordered by season):
+        grouped_by_season = {}
+        for value in values:
+            grouped_by_season.setdefault(id_from_item_url(value['season']), []).append(value)
         for season_item, expected_number_of_episodes in season_to_number_of_episodes.items():
             if season_item in grouped_by_season:
                 n_episodes_from_part_of = len(grouped_by_season[season_item])
@@ -189,7 +196,7 @@ def report_extra_queries(query_service, series_item):
                     )
         for value in values:
             if value.get('seriesStatement'):
-                if not value['episodeNumber']:
+                if not value.get('episodeNumber'):
                     report_items.append(
                         (
                             False,
@@ -73,6 +73,14 @@ SELECT ?episodeLabel ?episode ?series ?seriesLabel ?episodeNumber
   }}
 }} ORDER BY xsd:integer(?episodeNumber) ?productionCode'''
 
+# The same, but for several series at once (given as e.g.
+# 'wd:Q2744 wd:Q5902'), for auditing the whole catalogue (see
+# audit.py):
+MULTI_SEASON_BATCH_QUERY_FMT = MULTI_SEASON_QUERY_FMT.replace(
+    'BIND(wd:{item} as ?series) .', 'VALUES ?series {{ {series} }}')
+SINGLE_SEASON_BATCH_QUERY_FMT = SINGLE_SEASON_QUERY_FMT.replace(
+    'BIND(wd:{item} as ?series) .', 'VALUES ?series {{ {series} }}')
+
 NUMBER_OF_SEASONS_FMT = '''
 SELECT ?numberOfSeasons WHERE {{
   wd:{item} wdt:P2437 ?numberOfSeasons
@@ -107,6 +115,48 @@ SELECT ?episode ?season ?seasonNumber ?episodeNumber ?seriesStatement WHERE {{
 }}
 ORDER BY ?seasonNumber ?episodeNumber'''
 
+# Everything the problem report for a series without episodes needs,
+# in one query: each row is from one of the parts of the UNION, and
+# which it's from can be told by which variables are bound. The parts
+# are NUMBER_OF_SEASONS_FMT, SEASONS_WITH_EPISODES_TOTALS_FMT,
+# EPISODES_FROM_SEASON_AND_SERIES_FMT (for every season of the series,
+# with ?season renamed ?episodeSeason) and LABEL_FOR_ITEM_FMT:
+SERIES_DIAGNOSTICS_FMT = '''
+SELECT ?numberOfSeasons ?season ?seasonNumber ?episodesInSeason
+       ?episode ?episodeSeason ?episodeNumber ?seriesStatement ?seriesLabel WHERE {{
+  {{
+    wd:{item} wdt:P2437 ?numberOfSeasons
+  }} UNION {{
+    ?season wdt:P31 wd:Q3464665 .
+    ?season p:P179 ?seasonSeriesStatement .
+    ?seasonSeriesStatement ps:P179 wd:{item}
+    OPTIONAL {{
+      ?seasonSeriesStatement pq:P1545 ?seasonNumber .
+    }}
+    OPTIONAL {{
+      ?season wdt:P1113 ?episodesInSeason
+    }}
+  }} UNION {{
+    ?episodeSeason wdt:P31 wd:Q3464665 .
+    ?episodeSeason p:P179 ?episodeSeasonSeriesStatement .
+    ?episodeSeasonSeriesStatement ps:P179 wd:{item} .
+    ?episode wdt:P361 ?episodeSeason
+    OPTIONAL {{
+      ?episode p:P179 ?seriesStatement .
+      ?seriesStatement ps:P179 wd:{item}
+      OPTIONAL {{
+        ?seriesStatement pq:P1545 ?episodeNumber
+      }}
+    }}
+  }} UNION {{
+    SELECT ?seriesLabel WHERE {{
+      BIND(wd:{item} as ?series)
+      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }}
+    }}
+  }}
+}}
+ORDER BY xsd:integer(?seasonNumber) ?episodeNumber'''
+
 IS_ITEM_A_TV_SERIES_FMT = 'ASK WHERE {{ wd:{item} wdt:P31/wdt:P279* wd:Q5398426 }}'
 
 LABEL_FOR_ITEM_FMT = '''SELECT ?seriesLabel WHERE {{
@@ -129,3 +179,23 @@ SELECT DISTINCT ?series ?nameWithoutLang (group_concat(?lang;separator=",") as ?
   BIND(STR(?name) AS ?nameWithoutLang)
 }} GROUP BY ?series ?nameWithoutLang ORDER BY ?nameWithoutLang
 '''
+
+TV_SERIES_CLASSES = '''SELECT DISTINCT ?class WHERE {
+  ?class wdt:P279* wd:Q5398426
+}'''
+
+EPISODE_CLASSES = '''SELECT DISTINCT ?class WHERE {
+  ?class wdt:P279* wd:Q21191270
+}'''
+
+# One page of the instances of a single subclass of 'television
+# series', so that fetching all series can be split into queries that
+# each finish well within the query service's timeout:
+TV_SERIES_OF_CLASS_FMT = '''SELECT ?series ?seriesLabel WHERE {{
+  {{
+    SELECT ?series WHERE {{
+      ?series wdt:P31 wd:{class_item}
+    }} ORDER BY ?series LIMIT {limit} OFFSET {offset}
+  }}
+  SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en" }}
+}}'''
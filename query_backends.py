@@ -0,0 +1,279 @@
+'''Where SPARQL queries are actually run
+
+Everything that needs a query run goes through query_backend, which
+is chosen by the QUERY_BACKEND environment variable:
+
+  live           the Wikidata Query Service (the default), or the
+                 endpoint in WDQS_ENDPOINT
+  record         the same, but also saving every result as a fixture
+                 in the directory QUERY_BACKEND_PATH
+  replay         only the fixtures saved in QUERY_BACKEND_PATH, so
+                 nothing is sent to the query service at all
+  episode-store  the SQLite episode store at QUERY_BACKEND_PATH (see
+                 episode_store.py), which can only answer the queries
+                 about a single series
+  rdflib         rdflib, over the RDF file at QUERY_BACKEND_PATH (e.g.
+                 an N-Triples extract of Wikidata)
+
+With QUERY_BACKEND_LATENCY set to a number of seconds, or a range like
+'0.5,3', every query is delayed by that long first, to simulate a slow
+query service.
+'''
+
+from contextlib import contextmanager
+import hashlib
+import json
+from os import environ
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlencode
+
+from SPARQLWrapper import GET, POST
+
+try:
+    import rdflib
+except ImportError:
+    rdflib = None
+
+from cache import redis_api, redis_incr
+from episode_store import EpisodeStore
+from http_pool import ConnectionPool
+import sparql_tsv
+
+WDQS_ENDPOINT = environ.get('WDQS_ENDPOINT', 'https://query.wikidata.org/sparql')
+WDQS_USER_AGENT = environ.get(
+    'WDQS_USER_AGENT', 'wikidata-tv (https://github.com/mhl/wikidata-tv)')
+WDQS_CONNECT_TIMEOUT = float(environ.get('WDQS_CONNECT_TIMEOUT', '5'))
+# The query service gives up on queries after 60 seconds:
+WDQS_READ_TIMEOUT = float(environ.get('WDQS_READ_TIMEOUT', '65'))
+WDQS_MAX_ATTEMPTS = int(environ.get('WDQS_MAX_ATTEMPTS', '3'))
+WDQS_MAX_IDLE_CONNECTIONS = int(environ.get('WDQS_MAX_IDLE_CONNECTIONS', '8'))
+
+QUERY_BACKEND = environ.get('QUERY_BACKEND', 'live')
+QUERY_BACKEND_PATH = environ.get('QUERY_BACKEND_PATH')
+QUERY_BACKEND_LATENCY = environ.get('QUERY_BACKEND_LATENCY')
+
+# The prefixes the Wikidata Query Service predefines, which the
+# queries in queries.py rely on:
+WIKIDATA_PREFIXES = {
+    'wd': 'http://www.wikidata.org/entity/',
+    'wdt': 'http://www.wikidata.org/prop/direct/',
+    'p': 'http://www.wikidata.org/prop/',
+    'ps': 'http://www.wikidata.org/prop/statement/',
+    'pq': 'http://www.wikidata.org/prop/qualifier/',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+}
+
+LABEL_SERVICE_RE = re.compile(r'SERVICE\s+wikibase:label\s*\{[^{}]*\}')
+
+
+class QueryNotAvailable(Exception):
+    '''Raised when a backend has no way of answering a query'''
+
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+class QueryBackend(object):
+
+    def run_query(self, query, method=GET):
+        '''Return the result of query in the SPARQL JSON results format'''
+        raise NotImplementedError
+
+    @contextmanager
+    def stream_query(self, query, method=GET):
+        '''Run a SELECT query, giving its head and an iterator over its bindings
+
+        Backends that can produce the bindings a few at a time
+        override this; the default just runs the whole query.'''
+        result = self.run_query(query, method)
+        yield result['head'], iter(result['results']['bindings'])
+
+
+def count_wdqs_event(event):
+    redis_incr(redis_api, 'stats:wdqs-{0}'.format(event))
+
+
+class LiveBackend(QueryBackend):
+    '''Sends queries to a SPARQL endpoint over persistent connections (see http_pool)'''
+
+    def __init__(self, endpoint=WDQS_ENDPOINT):
+        self.pool = ConnectionPool(
+            endpoint,
+            max_idle_connections=WDQS_MAX_IDLE_CONNECTIONS,
+            connect_timeout=WDQS_CONNECT_TIMEOUT,
+            read_timeout=WDQS_READ_TIMEOUT,
+            max_attempts=WDQS_MAX_ATTEMPTS,
+            on_event=count_wdqs_event,
+        )
+
+    def request(self, query, accept, method):
+        headers = {'Accept': accept, 'User-Agent': WDQS_USER_AGENT}
+        parameters = urlencode({'query': query})
+        # The query service caches the results of GET requests but not
+        # POST requests, so POST is used to get fresh results:
+        if method == POST:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            return self.pool.request('POST', self.pool.path, parameters, headers)
+        return self.pool.request('GET', '{0}?{1}'.format(self.pool.path, parameters), headers=headers)
+
+    def run_query(self, query, method=GET):
+        response = self.request(query, 'application/sparql-results+json', method)
+        try:
+            return json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+
+    @contextmanager
+    def stream_query(self, query, method=GET):
+        # TSV (unlike JSON) can be parsed a line at a time as it arrives:
+        response = self.request(query, 'text/tab-separated-values', method)
+        try:
+            yield sparql_tsv.parse_stream(response)
+        finally:
+            response.close()
+
+
+def fixture_path(directory, query):
+    digest = hashlib.sha1(normalize_query(query).encode('utf-8')).hexdigest()
+    return os.path.join(directory, '{0}.json'.format(digest))
+
+
+class RecordingBackend(QueryBackend):
+    '''Runs queries with another backend, saving each result as a fixture for ReplayBackend
+
+    Results are recorded whole, so stream_query isn't incremental.'''
+
+    def __init__(self, backend, directory):
+        self.backend = backend
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def run_query(self, query, method=GET):
+        result = self.backend.run_query(query, method)
+        path = fixture_path(self.directory, query)
+        temporary_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        with open(temporary_path, 'w') as f:
+            json.dump({'query': normalize_query(query), 'result': result}, f)
+        os.replace(temporary_path, path)
+        return result
+
+
+class ReplayBackend(QueryBackend):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def run_query(self, query, method=GET):
+        try:
+            with open(fixture_path(self.directory, query)) as f:
+                return json.load(f)['result']
+        except FileNotFoundError:
+            raise QueryNotAvailable('No fixture recorded for: {0}'.format(normalize_query(query)))
+
+
+class EpisodeStoreBackend(QueryBackend):
+
+    def __init__(self, path):
+        self.episode_store = EpisodeStore(path)
+
+    def run_query(self, query, method=GET):
+        result = self.episode_store.answer(normalize_query(query))
+        if result is None:
+            raise QueryNotAvailable('The episode store can\'t answer: {0}'.format(normalize_query(query)))
+        return result
+
+
+def without_label_service(query):
+    '''Rewrite query to get English labels from rdfs:label instead of the label service
+
+    As with the label service, an item with no English label gets its
+    Q-id as its label.'''
+    def label_patterns(match):
+        patterns = []
+        for variable in sorted(set(re.findall(r'\?(\w+)Label\b', query))):
+            patterns.append(
+                'OPTIONAL {{ ?{0} rdfs:label ?{0}EnLabel FILTER(LANG(?{0}EnLabel) = "en") }} '
+                'BIND(COALESCE(?{0}EnLabel, STRAFTER(STR(?{0}), STR(wd:))) AS ?{0}Label)'.format(variable)
+            )
+        return ' '.join(patterns)
+    return LABEL_SERVICE_RE.sub(label_patterns, query)
+
+
+class RdflibBackend(QueryBackend):
+    '''Runs queries with rdflib over a local RDF file
+
+    This is slow, and only suitable for small extracts of Wikidata,
+    but can run any of the queries in queries.py.'''
+
+    def __init__(self, path):
+        if rdflib is None:
+            raise Exception('The rdflib query backend needs rdflib to be installed')
+        self.path = path
+        self.graph = None
+        self.lock = threading.Lock()
+
+    def get_graph(self):
+        with self.lock:
+            if self.graph is None:
+                graph = rdflib.Graph()
+                graph.parse(self.path, format=rdflib.util.guess_format(self.path))
+                self.graph = graph
+            return self.graph
+
+    def run_query(self, query, method=GET):
+        graph = self.get_graph()
+        # rdflib's SPARQL evaluation isn't safe to run concurrently
+        # over the same graph:
+        with self.lock:
+            result = graph.query(without_label_service(query), initNs=WIKIDATA_PREFIXES)
+            return json.loads(result.serialize(format='json'))
+
+
+class LatencyBackend(QueryBackend):
+    '''Delays every query to another backend by between min_delay and max_delay seconds'''
+
+    def __init__(self, backend, min_delay, max_delay):
+        self.backend = backend
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def delay(self):
+        time.sleep(random.uniform(self.min_delay, self.max_delay))
+
+    def run_query(self, query, method=GET):
+        self.delay()
+        return self.backend.run_query(query, method)
+
+    @contextmanager
+    def stream_query(self, query, method=GET):
+        self.delay()
+        with self.backend.stream_query(query, method) as head_and_bindings:
+            yield head_and_bindings
+
+
+def make_query_backend(name, path=None, latency=None):
+    if name == 'live':
+        backend = LiveBackend()
+    elif name == 'record':
+        backend = RecordingBackend(LiveBackend(), path)
+    elif name == 'replay':
+        backend = ReplayBackend(path)
+    elif name == 'episode-store':
+        backend = EpisodeStoreBackend(path)
+    elif name == 'rdflib':
+        backend = RdflibBackend(path)
+    else:
+        raise Exception('Unknown query backend: {0}'.format(name))
+    if latency:
+        delays = [float(delay) for delay in latency.split(',')]
+        backend = LatencyBackend(backend, delays[0], delays[-1])
+    return backend
+
+
+query_backend = make_query_backend(QUERY_BACKEND, QUERY_BACKEND_PATH, QUERY_BACKEND_LATENCY)
@@ -0,0 +1,206 @@
+'''Keeping cached series up to date with Wikidata's recent changes
+
+Rather than relying on cached models expiring, follow-recent-changes
+reads the stream of edits to Wikidata (from Wikimedia's EventStreams
+service, or a file of recorded events for testing) and, for every
+edited item that's in a cached SeriesModel (see
+series.series_containing), either drops that series' cached model
+and query results or fetches them again (bypassing the query
+service's own cache), RECENT_CHANGES_DELAY seconds later so that the
+query service has caught up with the edit. With that running, the
+series model and episode query TTLs can be made much longer (with
+SERIES_MODEL_CACHE_EXPIRY and CACHE_TTLS_EPISODES).
+
+Only edits to items already in a cached model are noticed: a new
+episode isn't until the series itself or one of its existing
+episodes is edited (e.g. to link to it with 'followed by'), or the
+model expires.
+
+The ID of the last event handled is kept in Redis, so after a restart
+the stream resumes from where it left off, as far back as EventStreams
+keeps events.
+'''
+
+import http.client
+from collections import deque
+from os import environ
+import json
+import logging
+import re
+import time
+
+from cache import redis_api, redis_get, redis_incr, redis_set
+from http_pool import ConnectionPool, HTTPError
+from series import (
+    fetch_series_model, invalidate_series, series_containing, set_cached_series_model)
+from warming import RateLimiter
+from wikidata import WikidataQueryService
+
+RECENT_CHANGES_URL = environ.get(
+    'RECENT_CHANGES_URL', 'https://stream.wikimedia.org/v2/stream/recentchange')
+RECENT_CHANGES_WIKI = 'wikidatawiki'
+# Changes are gathered for this many seconds, so that a series edited
+# many times in quick succession is only updated once:
+RECENT_CHANGES_BATCH_SECONDS = float(environ.get('RECENT_CHANGES_BATCH_SECONDS', '10'))
+RECENT_CHANGES_REFETCHES_PER_MINUTE = int(environ.get('RECENT_CHANGES_REFETCHES_PER_MINUTE', '10'))
+# The Wikidata Query Service usually has an edit within a minute or so,
+# so changes aren't acted on until this many seconds after they're
+# seen; otherwise a series could be refetched from before the edit and
+# that cached for a long time:
+RECENT_CHANGES_DELAY = float(environ.get('RECENT_CHANGES_DELAY', '120'))
+RECENT_CHANGES_RETRY_INTERVAL = 10
+LAST_EVENT_ID_KEY = 'recent-changes-last-event-id'
+
+USER_AGENT = environ.get(
+    'WDQS_USER_AGENT', 'wikidata-tv (https://github.com/mhl/wikidata-tv)')
+
+ITEM_TITLE_RE = re.compile(r'^Q\d+$')
+
+logger = logging.getLogger(__name__)
+
+
+def changed_item(event):
+    '''Return the Q-id of the item that event changed, or None if it's not an item on Wikidata'''
+    if event.get('wiki') != RECENT_CHANGES_WIKI or event.get('namespace') != 0:
+        return None
+    title = event.get('title', '')
+    if ITEM_TITLE_RE.match(title):
+        return title
+    return None
+
+
+def parse_server_sent_events(lines):
+    '''Yield the ID and decoded data of each message in a stream of server-sent events'''
+    event_id = None
+    data = []
+    for line in lines:
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            if data:
+                yield event_id, json.loads('\n'.join(data))
+            event_id, data = None, []
+        elif line.startswith('id:'):
+            event_id = line[3:].strip()
+        elif line.startswith('data:'):
+            data.append(line[5:].strip())
+    if data:
+        yield event_id, json.loads('\n'.join(data))
+
+
+def stream_events(url=RECENT_CHANGES_URL):
+    '''Yield (event ID, event) for each recent change, reconnecting whenever the stream drops'''
+    pool = ConnectionPool(url, max_idle_connections=1, read_timeout=60)
+    while True:
+        headers = {'Accept': 'text/event-stream', 'User-Agent': USER_AGENT}
+        last_event_id = redis_get(redis_api, LAST_EVENT_ID_KEY)
+        if last_event_id is not None:
+            headers['Last-Event-ID'] = last_event_id.decode('utf-8')
+        try:
+            response = pool.request('GET', pool.path, headers=headers)
+            try:
+                for event_id, event in parse_server_sent_events(response):
+                    yield event_id, event
+            finally:
+                response.close()
+        except (OSError, ValueError, HTTPError, http.client.HTTPException) as e:
+            logger.warning('Lost the recent changes stream (%s), reconnecting', e)
+            time.sleep(RECENT_CHANGES_RETRY_INTERVAL)
+
+
+def replay_events(path):
+    '''Yield (None, event) for each event in a file with one JSON event per line'''
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield None, json.loads(line)
+
+
+def update_series(series_item, refetch, rate_limiter):
+    if not refetch:
+        invalidate_series(series_item)
+        return
+    rate_limiter.wait()
+    # Purging sends the queries with POST, which the query service
+    # doesn't answer from its own cache:
+    _, model = fetch_series_model(WikidataQueryService(purge_cache=True), series_item)
+    if model is None:
+        invalidate_series(series_item)
+    else:
+        set_cached_series_model(model, purge=True)
+
+
+class ChangeBatcher(object):
+    '''Gathers the items changed by events, and updates the series they're in
+
+    Each batch of changes is held until RECENT_CHANGES_DELAY seconds
+    after it was gathered, and batches are handled in order.'''
+
+    def __init__(self, refetch, batch_seconds=RECENT_CHANGES_BATCH_SECONDS, delay=RECENT_CHANGES_DELAY):
+        self.refetch = refetch
+        self.batch_seconds = batch_seconds
+        self.delay = delay
+        self.rate_limiter = RateLimiter(RECENT_CHANGES_REFETCHES_PER_MINUTE)
+        self.items = set()
+        self.last_event_id = None
+        self.started_at = time.time()
+        # (when it's due, items, last event ID) for each gathered batch:
+        self.batches = deque()
+
+    def add(self, event_id, event):
+        item = changed_item(event)
+        if item is not None:
+            self.items.add(item)
+        if event_id is not None:
+            self.last_event_id = event_id
+        if time.time() - self.started_at >= self.batch_seconds:
+            self.end_batch()
+        self.handle_due_batches()
+
+    def end_batch(self):
+        self.batches.append((time.time() + self.delay, self.items, self.last_event_id))
+        self.items = set()
+        self.started_at = time.time()
+
+    def handle_due_batches(self, wait=False):
+        '''Handle the batches that are due, or if wait is set, all of them as they become due'''
+        while self.batches:
+            due_at, items, last_event_id = self.batches[0]
+            if time.time() < due_at:
+                if not wait:
+                    return
+                time.sleep(max(0, due_at - time.time()))
+            self.handle_batch(items, last_event_id)
+            self.batches.popleft()
+
+    def handle_batch(self, items, last_event_id):
+        series_items = series_containing(items)
+        for series_item in sorted(series_items):
+            try:
+                update_series(series_item, self.refetch, self.rate_limiter)
+                redis_incr(redis_api, 'stats:recent-changes-series-updated')
+            except Exception:
+                logger.exception('Failed to update %s after it changed', series_item)
+        if series_items:
+            logger.info('Updated %d series after changes to %d items', len(series_items), len(items))
+        # Only now that the changes have been handled, remember where
+        # to resume from:
+        if last_event_id is not None:
+            redis_set(redis_api, LAST_EVENT_ID_KEY, last_event_id)
+
+    def flush(self):
+        self.end_batch()
+        self.handle_due_batches(wait=True)
+
+
+def follow(events, refetch=False, delay=RECENT_CHANGES_DELAY):
+    '''Update the cached series affected by each of events
+
+    events is an iterable of (event ID, event) pairs, as from
+    stream_events or replay_events. If refetch is set, affected series
+    are fetched again; otherwise their cached models and query
+    results are just dropped, to be fetched on the next request.
+    Either is done delay seconds after the change is seen.'''
+    batcher = ChangeBatcher(refetch, delay=delay)
+    for event_id, event in events:
+        batcher.add(event_id, event)
+    batcher.flush()
@@ -0,0 +1,164 @@
+'''Picking random episodes of a series
+
+Everything needed to pick an episode is worked out once, when a
+SeriesModel is built, so that each pick takes constant time however
+many episodes the series has:
+
+ - 'uniform' picks any episode with equal probability.
+ - 'by-season' picks a season with equal probability, then an episode
+   from it, so that one very long season doesn't crowd out the rest.
+ - 'fewer-specials' makes specials (season 0) SAMPLING_SPECIALS_WEIGHT
+   times as likely as other episodes.
+ - 'no-repeat' goes through the episodes in a shuffled order, so none
+   comes up twice until all of them have. The order isn't stored: it's
+   a pseudo-random permutation computed from a seed, and only the seed
+   and how far through it each visitor is are kept, in Redis.
+
+The weighted picks use alias tables (Vose's method). Any of them can
+be restricted to one season, within which every mode but 'no-repeat'
+is just a uniform pick.
+'''
+
+from array import array
+import hashlib
+from os import environ
+import random
+
+from cache import redis_api, redis_key
+
+PICK_MODES = ('uniform', 'by-season', 'fewer-specials', 'no-repeat')
+SAMPLING_SPECIALS_WEIGHT = float(environ.get('SAMPLING_SPECIALS_WEIGHT', '0.1'))
+SPECIALS_SEASON_NUMBER = 0
+
+# Each visitor's place in the shuffled order of each series is
+# forgotten after this long without picking from it:
+SHUFFLE_CURSOR_EXPIRY = 7 * 24 * 60 * 60
+FEISTEL_ROUNDS = 4
+
+
+class AliasTable(object):
+    '''Picks an index with probability proportional to its weight, in constant time'''
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * n / total for weight in weights]
+        self.probability = array('d', [1.0]) * n
+        self.alias = array('l', range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # Whatever's left over only differs from 1 by rounding errors,
+        # so keeps its probability of 1.
+
+    def pick(self, rng=random):
+        i = rng.randrange(len(self.probability))
+        if rng.random() < self.probability[i]:
+            return i
+        return self.alias[i]
+
+
+def _round_value(seed, round_number, value):
+    digest = hashlib.blake2b(
+        '{0}:{1}:{2}'.format(seed, round_number, value).encode('ascii'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def permuted_index(seed, position, n):
+    '''Return what's at position in a pseudo-random shuffle of range(n) chosen by seed
+
+    This is a small Feistel network over the smallest range of an even
+    number of bits that holds n, which is a permutation of that range;
+    values outside range(n) are put through it again until one isn't
+    ("cycle walking"), which on average takes fewer than four goes.'''
+    half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+    i = position
+    while True:
+        left, right = i >> half_bits, i & mask
+        for round_number in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ (_round_value(seed, round_number, right) & mask)
+        i = (left << half_bits) | right
+        if i < n:
+            return i
+
+
+class EpisodeSampler(object):
+    '''The precomputed tables for picking from a series' episodes
+
+    Picks are returned as indexes into the list of episodes the sampler
+    was made from.'''
+
+    def __init__(self, episodes):
+        self.n_episodes = len(episodes)
+        self.season_indexes = {}
+        for i, episode in enumerate(episodes):
+            self.season_indexes.setdefault(episode.season_number, array('l')).append(i)
+        season_sizes = [
+            len(self.season_indexes[episode.season_number]) for episode in episodes
+        ]
+        self.alias_tables = {
+            'by-season': AliasTable([1.0 / size for size in season_sizes]),
+            'fewer-specials': AliasTable([
+                SAMPLING_SPECIALS_WEIGHT if episode.season_number == SPECIALS_SEASON_NUMBER else 1.0
+                for episode in episodes
+            ]),
+        }
+
+    @property
+    def seasons(self):
+        '''The season numbers that can be picked from, in order'''
+        return sorted(season for season in self.season_indexes if season is not None)
+
+    def candidates(self, season=None):
+        '''Return the number of episodes to pick from, and how to turn a pick into an index'''
+        if season is None:
+            return self.n_episodes, lambda i: i
+        indexes = self.season_indexes.get(season, ())
+        return len(indexes), indexes.__getitem__
+
+    def pick(self, mode='uniform', season=None, rng=random):
+        '''Return the index of a random episode (or None if season has none)
+
+        mode is any of PICK_MODES but 'no-repeat', for which see
+        next_unseen.'''
+        n, index = self.candidates(season)
+        if n == 0:
+            return None
+        if season is None and mode in self.alias_tables:
+            return self.alias_tables[mode].pick(rng)
+        return index(rng.randrange(n))
+
+    def next_unseen(self, scope, session_id, season=None):
+        '''Return the index of the next episode in session_id's shuffled order
+
+        scope identifies the series; each season that's picked from has
+        its own order. When every episode has been picked, they're
+        shuffled again.'''
+        n, index = self.candidates(season)
+        if n == 0:
+            return None
+        key = redis_key('shuffle:{0}'.format(session_id))
+        field = '{0}:{1}'.format(scope, 'all' if season is None else season)
+        pipeline = redis_api.pipeline(transaction=False)
+        pipeline.hincrby(key, field + ':position', 1)
+        pipeline.hget(key, field + ':seed')
+        pipeline.expire(key, SHUFFLE_CURSOR_EXPIRY)
+        position, seed_and_n, _ = pipeline.execute()
+        position -= 1
+        # The order's for a particular number of episodes, so start a
+        # new one if that's changed as well as when it's finished:
+        if seed_and_n is None or position >= n or int(seed_and_n.split(b':')[1]) != n:
+            seed, position = random.getrandbits(63), 0
+            redis_api.hmset(key, {
+                field + ':seed': '{0}:{1}'.format(seed, n),
+                field + ':position': 1,
+            })
+        else:
+            seed = int(seed_and_n.split(b':')[0])
+        return index(permuted_index(seed, position, n))
@@ -0,0 +1,87 @@
+'''Searching the list of all television series without a SPARQL query
+
+Labels are case-folded and have their accents removed, then joined
+into one string, which str.find can scan for a substring in a few
+milliseconds even with hundreds of thousands of labels. An item can
+appear more than once with different labels (e.g. in different
+languages) and matches on any of them.
+'''
+
+from bisect import bisect_right
+import threading
+import unicodedata
+
+SEPARATOR = '\n'
+
+
+def normalize(s):
+    decomposed = unicodedata.normalize('NFKD', s)
+    without_accents = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return without_accents.casefold().replace(SEPARATOR, ' ')
+
+
+class SearchIndex(object):
+
+    def __init__(self, items_with_labels):
+        self.items_with_labels = list(items_with_labels)
+        self.starts = []
+        position = 0
+        normalized_labels = []
+        for _, label in self.items_with_labels:
+            normalized_label = normalize(label)
+            self.starts.append(position)
+            normalized_labels.append(normalized_label)
+            position += len(normalized_label) + len(SEPARATOR)
+        self.text = SEPARATOR.join(normalized_labels)
+
+    def search(self, query, limit=None):
+        '''Return the (item, label) tuples whose label contains query
+
+        Matching ignores case and accents. Results are in the order of
+        the list the index was built from, with each (item, label)
+        included only once.'''
+        normalized_query = normalize(query).strip()
+        if not normalized_query:
+            return []
+        results = []
+        seen = set()
+        position = self.text.find(normalized_query)
+        while position >= 0:
+            label_index = bisect_right(self.starts, position) - 1
+            item_with_label = self.items_with_labels[label_index]
+            if item_with_label not in seen:
+                seen.add(item_with_label)
+                results.append(item_with_label)
+                if limit is not None and len(results) >= limit:
+                    break
+            # Carry on from the start of the next label:
+            if label_index + 1 >= len(self.starts):
+                break
+            position = self.text.find(normalized_query, self.starts[label_index + 1])
+        return results
+
+
+class SearchIndexHolder(object):
+    '''Keeps one SearchIndex per process, rebuilding it when its source changes'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.index = None
+
+    def get(self, version, get_items_with_labels):
+        '''Return the index for version, building it from get_items_with_labels() if needed
+
+        If get_items_with_labels() returns None (e.g. the list has
+        gone), so does this, and nothing is kept for version.'''
+        if self.version == version:
+            return self.index
+        with self.lock:
+            if self.version != version:
+                items_with_labels = get_items_with_labels()
+                if items_with_labels is None:
+                    return None
+                self.index = SearchIndex(
+                    tuple(item_with_label) for item_with_label in items_with_labels)
+                self.version = version
+            return self.index
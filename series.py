@@ -0,0 +1,206 @@
+from os import environ
+import time
+
+from cache import (
+    CACHE_POLICIES, invalidate_local_caches, redis_api, redis_get_object, redis_key, redis_purge,
+    redis_set_object, redis_ttl)
+from episodes import link_episodes, order_episodes, parse_episodes
+import problems
+import queries
+from sampling import EpisodeSampler
+from wikidata import query_cache_key
+
+# Bump this whenever the shape of SeriesModel (or of the Episode
+# objects it holds) changes, so that models pickled by older code are
+# never loaded:
+SERIES_MODEL_VERSION = 6
+# A model is only as fresh as the episode queries it was built from,
+# unless the cache is kept up to date with Wikidata's recent changes
+# (see recent_changes.py), when this can be much longer:
+SERIES_MODEL_CACHE_EXPIRY = int(environ.get(
+    'SERIES_MODEL_CACHE_EXPIRY', str(CACHE_POLICIES['episodes'].soft_ttl)))
+
+# Maps the Q-id of every series, season and episode in a cached model
+# to the series, so that a change to any of them can be traced back to
+# the models it affects. Models are indexed in a hash per
+# SERIES_MODEL_CACHE_EXPIRY seconds, so a model that's still cached is
+# always in the current hash or the one before, and older hashes are
+# left to expire rather than the index growing forever:
+SERIES_INDEX_KEY = 'series-index'
+SERIES_INDEX_BATCH_SIZE = 1000
+
+
+class SeriesModel(object):
+    '''Everything the series page needs, built once from the SPARQL results
+
+    This is what gets cached per series, so that picking another
+    random episode doesn't need to re-run or re-parse any queries.'''
+
+    def __init__(self, series_item, uses_single_season_modelling, ordering,
+                 report_items, queries_used):
+        self.series_item = series_item
+        self.uses_single_season_modelling = uses_single_season_modelling
+        self.ordering = ordering
+        self.report_items = report_items
+        self.queries_used = queries_used
+        self.sampler = EpisodeSampler(self.episodes)
+        # This identifies the model, e.g. for ETags in the API:
+        self.built_at = time.time()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # The previous / next episode links aren't pickled (see
+        # Episode.__getstate__) so restore them here:
+        link_episodes(self.episodes)
+
+    @property
+    def episodes(self):
+        return self.ordering.episodes
+
+    @property
+    def episodes_table_data(self):
+        return self.ordering.seasons
+
+    @property
+    def series_name(self):
+        return self.episodes[0].series_name
+
+    def random_episode(self, mode='uniform', season=None, session_id=None):
+        '''Return a random episode, picked as described in sampling.py
+
+        Returns None if there are no episodes in season. session_id is
+        only needed for the 'no-repeat' mode.'''
+        if mode == 'no-repeat':
+            i = self.sampler.next_unseen(self.series_item, session_id, season)
+        else:
+            i = self.sampler.pick(mode, season)
+        return None if i is None else self.episodes[i]
+
+    def items(self):
+        '''Return the Q-ids of the series and all its seasons and episodes'''
+        items = {self.series_item}
+        for episode in self.episodes:
+            items.add(episode.item)
+            if episode.season_item:
+                items.add(episode.season_item)
+        return items
+
+
+def series_model_key(series_item):
+    return 'series-model:v{version}:{item}'.format(
+        version=SERIES_MODEL_VERSION, item=series_item)
+
+
+def get_cached_series_model(series_item):
+    return redis_get_object(redis_api, series_model_key(series_item))
+
+
+def cached_series_model_ttl(series_item):
+    '''Return how many seconds the cached model of series_item has left, or None if it isn't cached'''
+    return redis_ttl(redis_api, series_model_key(series_item))
+
+
+def set_cached_series_model(model, purge=False):
+    # The model and its index entries are written in one round trip:
+    key = series_model_key(model.series_item)
+    pipeline = redis_api.pipeline(transaction=False)
+    redis_set_object(pipeline, key, model, SERIES_MODEL_CACHE_EXPIRY)
+    index_series_model(model, pipeline)
+    pipeline.execute()
+    if purge:
+        invalidate_local_caches(key)
+
+
+def series_index_key(period):
+    return redis_key('{0}:{1}'.format(SERIES_INDEX_KEY, period))
+
+
+def current_series_index_period():
+    return int(time.time() // SERIES_MODEL_CACHE_EXPIRY)
+
+
+def index_series_model(model, pipeline):
+    key = series_index_key(current_series_index_period())
+    items = sorted(model.items())
+    for start in range(0, len(items), SERIES_INDEX_BATCH_SIZE):
+        pipeline.hmset(
+            key, {item: model.series_item for item in items[start:start + SERIES_INDEX_BATCH_SIZE]})
+    # Long enough for it to be the one before the current hash:
+    pipeline.expire(key, 2 * SERIES_MODEL_CACHE_EXPIRY)
+
+
+def series_containing(items):
+    '''Return the set of series whose cached models include any of items'''
+    items = list(items)
+    period = current_series_index_period()
+    keys = [series_index_key(period), series_index_key(period - 1)]
+    series_items = set()
+    for start in range(0, len(items), SERIES_INDEX_BATCH_SIZE):
+        batch = items[start:start + SERIES_INDEX_BATCH_SIZE]
+        pipeline = redis_api.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hmget(key, batch)
+        for results in pipeline.execute():
+            series_items.update(
+                series_item.decode('utf-8') for series_item in results if series_item is not None)
+    return series_items
+
+
+def series_queries(wikidata_item):
+    return [
+        queries.IS_ITEM_A_TV_SERIES_FMT.format(item=wikidata_item),
+        queries.MULTI_SEASON_QUERY_FMT.format(item=wikidata_item),
+        queries.SINGLE_SEASON_QUERY_FMT.format(item=wikidata_item),
+    ]
+
+
+def invalidate_series(wikidata_item):
+    '''Drop the cached model of wikidata_item, and the query results it was built from'''
+    redis_purge(redis_api, series_model_key(wikidata_item))
+    for query in series_queries(wikidata_item):
+        redis_purge(redis_api, query_cache_key(query))
+
+
+def fetch_series_model(query_service, wikidata_item):
+    '''Run the queries for wikidata_item and build its SeriesModel
+
+    Returns a tuple of whether wikidata_item is a television series
+    and its SeriesModel, which is None if no episodes could be found
+    with either the multi-season or the single-season modelling.'''
+    # Check that the item we have actually is an instance of a
+    # 'television series' (Q5398426) while getting its episodes
+    # assuming multi-season modelling. Most series are modelled that
+    # way, so the single-season query is only sent if that finds no
+    # episodes. The episodes are parsed as the results stream in.
+    is_tv_series_query, multi_season_query, single_season_query = series_queries(wikidata_item)
+    is_tv_series_results, episodes = query_service.run_queries([
+        (
+            is_tv_series_query,
+            'Checking that {0} is really a television series'.format(wikidata_item)
+        ),
+        (
+            multi_season_query,
+            'Getting episodes of {0} assuming multi-season modelling'.format(wikidata_item),
+            parse_episodes
+        ),
+    ])
+    if not is_tv_series_results['boolean']:
+        return False, None
+    uses_single_season_modelling = False
+    if not episodes:
+        episodes = query_service.run_query(
+            single_season_query,
+            'Getting episodes of {0} assuming single-season modelling'.format(wikidata_item),
+            consume=parse_episodes
+        )
+        uses_single_season_modelling = True
+        if not episodes:
+            return True, None
+    ordering = order_episodes(episodes)
+    return True, SeriesModel(
+        series_item=wikidata_item,
+        uses_single_season_modelling=uses_single_season_modelling,
+        ordering=ordering,
+        report_items=problems.report(ordering),
+        queries_used=list(query_service.queries),
+    )
@@ -0,0 +1,98 @@
+'''Incremental parsing of SPARQL results in the TSV format
+
+The Wikidata Query Service can return SELECT results as tab-separated
+values, one result per line, which (unlike its JSON) can be parsed a
+line at a time. Each binding is converted to the same dict that the
+JSON format would have given for it, so the rest of the code needn't
+care which format was used.
+'''
+
+import re
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+ESCAPES = {
+    't': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f',
+    '"': '"', "'": "'", '\\': '\\',
+}
+
+ESCAPE_RE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+
+BARE_LITERALS = [
+    (re.compile(r'^[+-]?\d+$'), XSD + 'integer'),
+    (re.compile(r'^[+-]?\d*\.\d+$'), XSD + 'decimal'),
+    (re.compile(r'^[+-]?(?:\d+\.?\d*|\.\d+)[eE][+-]?\d+$'), XSD + 'double'),
+    (re.compile(r'^(?:true|false)$'), XSD + 'boolean'),
+]
+
+
+def _unescape(match):
+    short_unicode, long_unicode, character = match.groups()
+    if character is not None:
+        return ESCAPES.get(character, character)
+    return chr(int(short_unicode or long_unicode, 16))
+
+
+def unescape(s):
+    if '\\' not in s:
+        return s
+    return ESCAPE_RE.sub(_unescape, s)
+
+
+def parse_term(term):
+    '''Return the SPARQL JSON binding value for a term from a TSV result
+
+    Returns None for an empty field, which means the variable is
+    unbound.'''
+    if not term:
+        return None
+    if term[0] == '<' and term[-1] == '>':
+        return {'type': 'uri', 'value': term[1:-1]}
+    if term.startswith('_:'):
+        return {'type': 'bnode', 'value': term[2:]}
+    if term[0] == '"':
+        end = term.rindex('"')
+        value = {'type': 'literal', 'value': unescape(term[1:end])}
+        suffix = term[end + 1:]
+        if suffix.startswith('@'):
+            value['xml:lang'] = suffix[1:]
+        elif suffix.startswith('^^<') and suffix.endswith('>'):
+            value['datatype'] = suffix[3:-1]
+        return value
+    for pattern, datatype in BARE_LITERALS:
+        if pattern.match(term):
+            return {'type': 'literal', 'value': term, 'datatype': datatype}
+    raise ValueError('Could not parse the TSV term: {0}'.format(term))
+
+
+def parse_header(line):
+    return [variable.lstrip('?$') for variable in line.rstrip('\r\n').split('\t')]
+
+
+def iter_bindings(lines, variables):
+    '''Yield a binding dict for each line of a TSV result after the header'''
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        binding = {}
+        for variable, term in zip(variables, line.split('\t')):
+            value = parse_term(term)
+            if value is not None:
+                binding[variable] = value
+        yield binding
+
+
+def parse_stream(lines):
+    '''Return the head and an iterator over the bindings of a TSV result
+
+    lines can be any iterable of lines, as bytes or str, such as an
+    HTTP response.'''
+    lines = iter(lines)
+    header = next(lines, b'')
+    if isinstance(header, bytes):
+        header = header.decode('utf-8-sig')
+    variables = parse_header(header) if header.strip() else []
+    return {'vars': variables}, iter_bindings(lines, variables)
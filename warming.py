@@ -0,0 +1,169 @@
+'''Keeping the cached models of popular series warm
+
+Every view of a series page adds to that series' score in a Redis
+sorted set. The scores decay with a half-life of
+SERIES_POPULARITY_HALF_LIFE, so they reflect what's being looked at
+lately rather than ever.
+
+The cache warmer (run by warm-series-cache, the Procfile's worker)
+regularly goes through the WARM_TOP_N most popular series, and any
+others it's given (e.g. the homepage's examples), and for each whose
+cached SeriesModel is missing or will expire within WARM_AHEAD
+seconds, re-runs its queries and rebuilds its model. So that it stays
+well within the Wikidata Query Service's usage policy, it never sends
+more than WARM_QUERIES_PER_MINUTE queries a minute, and it takes a
+lock so that only one warmer runs at a time.
+
+Each series warmed costs up to three queries (see
+WARM_QUERIES_PER_SERIES) every SERIES_MODEL_CACHE_EXPIRY - WARM_AHEAD
+seconds, so the rate limit caps how many series can be kept warm
+(see warmable_series_count): with the defaults (a 3 minute TTL,
+warming 1 minute ahead and 30 queries a minute) that's at least 20,
+enough for the top 5 plus the homepage's 10 examples with some room
+to spare. Raise WARM_TOP_N along with WARM_QUERIES_PER_MINUTE or
+SERIES_MODEL_CACHE_EXPIRY, or the least popular series will expire
+before the warmer gets to them.
+'''
+
+from os import environ
+import logging
+import time
+
+from cache import acquire_lock, redis_api, redis_key, release_lock
+from series import (
+    SERIES_MODEL_CACHE_EXPIRY, cached_series_model_ttl, fetch_series_model, set_cached_series_model)
+from wikidata import WikidataQueryService
+
+SERIES_POPULARITY_KEY = 'series-popularity'
+SERIES_POPULARITY_DECAYED_AT_KEY = 'series-popularity-decayed-at'
+SERIES_POPULARITY_HALF_LIFE = int(environ.get('SERIES_POPULARITY_HALF_LIFE', str(24 * 60 * 60)))
+# Only this many of the most popular series are remembered:
+SERIES_POPULARITY_MAX_SERIES = int(environ.get('SERIES_POPULARITY_MAX_SERIES', '10000'))
+
+# This many of the most popular series are kept warm, as well as the
+# homepage's examples; see warmable_series_count for how many the rate
+# limit allows:
+WARM_TOP_N = int(environ.get('WARM_TOP_N', '5'))
+WARM_AHEAD = int(environ.get('WARM_AHEAD', '60'))
+WARM_INTERVAL = int(environ.get('WARM_INTERVAL', '30'))
+WARM_QUERIES_PER_MINUTE = int(environ.get('WARM_QUERIES_PER_MINUTE', '30'))
+# A round of warming stops after half this long (leaving the rest for
+# the next round) so that it never outlasts its lock:
+WARM_LOCK_TIMEOUT = 15 * 60
+# fetch_series_model runs at most this many queries (only two for
+# series with multi-season modelling, which is most of them):
+WARM_QUERIES_PER_SERIES = 3
+
+logger = logging.getLogger(__name__)
+
+
+def record_series_request(series_item):
+    redis_api.zincrby(redis_key(SERIES_POPULARITY_KEY), value=series_item, amount=1)
+
+
+def decay_series_popularity():
+    '''Scale down every series' score for the time since this was last done
+
+    Then forget all but the SERIES_POPULARITY_MAX_SERIES most popular.'''
+    now = time.time()
+    decayed_at = redis_api.getset(redis_key(SERIES_POPULARITY_DECAYED_AT_KEY), now)
+    if decayed_at is None:
+        return
+    factor = 0.5 ** ((now - float(decayed_at)) / SERIES_POPULARITY_HALF_LIFE)
+    key = redis_key(SERIES_POPULARITY_KEY)
+    pipeline = redis_api.pipeline()
+    pipeline.zunionstore(key, {key: factor})
+    pipeline.zremrangebyrank(key, 0, -(SERIES_POPULARITY_MAX_SERIES + 1))
+    pipeline.execute()
+
+
+def most_popular_series(n):
+    return [
+        item.decode('utf-8')
+        for item in redis_api.zrevrange(redis_key(SERIES_POPULARITY_KEY), 0, n - 1)
+    ]
+
+
+def needs_warming(series_item):
+    ttl = cached_series_model_ttl(series_item)
+    return ttl is None or ttl <= WARM_AHEAD
+
+
+def warmable_series_count():
+    '''Return how many series the rate limit allows to be kept warm
+
+    Each has to be warmed again every SERIES_MODEL_CACHE_EXPIRY -
+    WARM_AHEAD seconds.'''
+    seconds_between_warmings = SERIES_MODEL_CACHE_EXPIRY - WARM_AHEAD
+    return int(WARM_QUERIES_PER_MINUTE * seconds_between_warmings / 60.0 / WARM_QUERIES_PER_SERIES)
+
+
+class RateLimiter(object):
+    '''Spaces out calls to wait so that there are at most per_minute of them a minute'''
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self.next_allowed = 0
+
+    def wait(self, n=1):
+        now = time.time()
+        if now < self.next_allowed:
+            time.sleep(self.next_allowed - now)
+            now = self.next_allowed
+        self.next_allowed = now + n * self.interval
+
+
+def warm_series(series_item, rate_limiter):
+    '''Refresh the queries for series_item and cache its rebuilt model'''
+    query_service = WikidataQueryService(refresh_cache=True)
+    rate_limiter.wait(WARM_QUERIES_PER_SERIES)
+    _, model = fetch_series_model(query_service, series_item)
+    if model is None:
+        # It's no longer a series with episodes, so don't keep trying:
+        redis_api.zrem(redis_key(SERIES_POPULARITY_KEY), series_item)
+        return
+    set_cached_series_model(model)
+
+
+def warm_once(extra_series_items, rate_limiter):
+    '''Warm whichever of the popular and extra series need it
+
+    Returns the number of series warmed, or None if another warmer
+    holds the lock.'''
+    token = acquire_lock(redis_api, 'lock:cache-warmer', WARM_LOCK_TIMEOUT)
+    if token is None:
+        return None
+    deadline = time.time() + WARM_LOCK_TIMEOUT / 2
+    try:
+        decay_series_popularity()
+        series_items = most_popular_series(WARM_TOP_N)
+        series_items.extend(item for item in extra_series_items if item not in series_items)
+        n_warmed = 0
+        for series_item in series_items:
+            if time.time() >= deadline:
+                break
+            if not needs_warming(series_item):
+                continue
+            try:
+                warm_series(series_item, rate_limiter)
+                n_warmed += 1
+            except Exception:
+                logger.exception('Failed to warm the cache for %s', series_item)
+        return n_warmed
+    finally:
+        release_lock(redis_api, 'lock:cache-warmer', token)
+
+
+def run_forever(extra_series_items=()):
+    n_series = WARM_TOP_N + len(set(extra_series_items))
+    if n_series > warmable_series_count():
+        logger.warning(
+            'Asked to keep up to %d series warm, but at %d queries a minute only %d can be',
+            n_series, WARM_QUERIES_PER_MINUTE, warmable_series_count())
+    rate_limiter = RateLimiter(WARM_QUERIES_PER_MINUTE)
+    while True:
+        started_at = time.time()
+        n_warmed = warm_once(extra_series_items, rate_limiter)
+        if n_warmed is not None:
+            logger.info('Warmed the cache for %d series', n_warmed)
+        time.sleep(max(0, WARM_INTERVAL - (time.time() - started_at)))
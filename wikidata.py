@@ -0,0 +1,328 @@
+from concurrent.futures import Future
+import hashlib
+from os import environ
+import re
+from threading import BoundedSemaphore, Lock, Thread
+import time
+
+from SPARQLWrapper import POST, GET
+
+from cache import (
+    CACHE_POLICIES, STALE_WHILE_REVALIDATE, acquire_lock, redis_api, redis_get_entries,
+    redis_get_entry, redis_incr, redis_set_entry, release_lock, schedule_refresh)
+from cache_codec import SelectResultBuilder, from_payload, iter_bindings, payload_rows, to_payload
+from episode_store import EPISODE_STORE_PATH, EpisodeStore
+from metrics import query_template_name, record_query
+from query_backends import query_backend
+
+# The maximum number of SPARQL queries a worker process will have in
+# flight to the Wikidata Query Service at once. This is shared by all
+# the requests the process is serving, which with gevent workers (see
+# gunicorn_config.py) may be many; the rest wait their turn without
+# holding up the worker. Only the requests to the query service count:
+# cache lookups, and waiting for another worker to fetch a result,
+# never wait for a slot.
+QUERY_CONCURRENCY = int(environ.get('QUERY_CONCURRENCY', '4'))
+
+query_service_slots = BoundedSemaphore(QUERY_CONCURRENCY)
+
+# When several workers miss the cache for the same query at once, only
+# the one that takes the lock runs it; the others poll the cache for
+# up to QUERY_COALESCE_WAIT seconds before giving up and running the
+# query themselves. The lock expires after QUERY_LOCK_TIMEOUT seconds
+# in case the worker holding it dies.
+QUERY_LOCK_TIMEOUT = 90
+QUERY_COALESCE_WAIT = float(environ.get('QUERY_COALESCE_WAIT', '30'))
+QUERY_COALESCE_POLL_INTERVAL = 0.1
+QUERY_COALESCE_MAX_POLL_INTERVAL = 1.0
+
+# Queries about series in the local episode store (if there is one)
+# are answered from it instead; see episode_store.py:
+episode_store = EpisodeStore(EPISODE_STORE_PATH) if EPISODE_STORE_PATH else None
+
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def query_cache_key(query):
+    # The queries are often kilobytes long, so the key is a hash of
+    # the query rather than the query itself:
+    digest = hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+    return 'query:sha256:{}'.format(digest)
+
+
+def discard(bindings):
+    for _ in bindings:
+        pass
+
+
+class WikidataQuery(object):
+    '''A query run for a page, and how it went
+
+    Once the query has finished, outcome is where its result came
+    from: 'hit' (the cache), 'stale' (the cache, but due a refresh),
+    'coalesced' (the cache, after waiting for another worker to fetch
+    it), 'miss' (the query service), 'purged' (the query service,
+    because the cache was being purged), 'refreshed' (the query
+    service, because the cache was being warmed), 'local' (the episode store)
+    or 'error'. seconds is how long that took, rows the number of
+    bindings in the result and size its size encoded for the cache
+    (None if it wasn't from, or put in, the cache).'''
+
+    def __init__(self, query, why=None):
+        self.query = query
+        self.why = why
+        self.template = query_template_name(query)
+        self.outcome = None
+        self.seconds = None
+        self.rows = None
+        self.size = None
+
+    def record_entry(self, outcome, entry):
+        '''Record where the result came from, and the cache entry it's in'''
+        payload, _, size = entry
+        self.outcome = outcome
+        self.rows = payload_rows(payload)
+        self.size = size
+
+
+class WikidataQueryService(object):
+
+    def __init__(self, purge_cache=False, refresh_cache=False):
+        '''If purge_cache is set, every query is sent to the query service
+        (bypassing its own cache too) and other processes are told to
+        drop their copies of the results. If refresh_cache is set,
+        every query is sent to the query service and the cached
+        result replaced, as when warming the cache (see warming.py).'''
+        self.queries = []
+        self.purge_cache = purge_cache
+        self.refresh_cache = refresh_cache
+        # Cache entries (or None for misses) looked up in advance by
+        # prefetch, by key; each is only used once:
+        self.prefetched = {}
+        self.prefetched_lock = Lock()
+
+    def _uncached_run_query(self, query, method=GET):
+        with query_service_slots:
+            return query_backend.run_query(query, method)
+
+    def _uncached_stream_query(self, query, consume, method=GET):
+        '''Run a SELECT query, passing an iterator over its bindings to consume
+
+        Where the backend supports it (see query_backends) the result
+        is parsed a line at a time as it arrives, so the whole response
+        is never held in memory at once. Returns the payload to cache
+        (see cache_codec) and the return value of consume.'''
+        with query_service_slots, query_backend.stream_query(query, method) as (head, bindings):
+            builder = SelectResultBuilder(head)
+            stream = builder.tee(bindings)
+            consumed = consume(stream)
+            # In case consume didn't need every binding, make sure they
+            # all still get cached:
+            for _ in stream:
+                pass
+        return builder.encode(), consumed
+
+    def _fetch_and_cache(self, key, normalized_query, policy, consume=None, method=GET):
+        if consume is None:
+            result = self._uncached_run_query(normalized_query, method)
+            payload, consumed = to_payload(result), result
+        else:
+            payload, consumed = self._uncached_stream_query(normalized_query, consume, method)
+        entry = redis_set_entry(redis_api, key, payload, policy, purge=(method == POST))
+        return entry, consumed
+
+    def _coalesced_fetch(self, wikidata_query, key, normalized_query, policy, consume=None):
+        '''Fetch a query that missed the cache, unless another worker already is
+
+        If another worker holds the lock for this query, wait for it to
+        put the result in the cache rather than sending a duplicate
+        query to the Wikidata Query Service.'''
+        lock_key = 'lock:{}'.format(key)
+        deadline = time.time() + QUERY_COALESCE_WAIT
+        poll_interval = QUERY_COALESCE_POLL_INTERVAL
+        while True:
+            token = acquire_lock(redis_api, lock_key, QUERY_LOCK_TIMEOUT)
+            if token is not None:
+                try:
+                    # The worker that held the lock before may have
+                    # finished between our cache check and taking it:
+                    entry = self._fresh_cached_entry(key, policy)
+                    if entry is not None:
+                        redis_incr(redis_api, 'stats:queries-coalesced')
+                        wikidata_query.record_entry('coalesced', entry)
+                        return self._consume_payload(entry[0], consume)
+                    redis_incr(redis_api, 'stats:queries-originated')
+                    entry, consumed = self._fetch_and_cache(key, normalized_query, policy, consume)
+                    wikidata_query.record_entry('miss', entry)
+                    return consumed
+                finally:
+                    release_lock(redis_api, lock_key, token)
+            if time.time() >= deadline:
+                redis_incr(redis_api, 'stats:queries-coalesce-timeouts')
+                entry, consumed = self._fetch_and_cache(key, normalized_query, policy, consume)
+                wikidata_query.record_entry('miss', entry)
+                return consumed
+            time.sleep(poll_interval)
+            poll_interval = min(2 * poll_interval, QUERY_COALESCE_MAX_POLL_INTERVAL)
+            entry = self._fresh_cached_entry(key, policy)
+            if entry is not None:
+                redis_incr(redis_api, 'stats:queries-coalesced')
+                wikidata_query.record_entry('coalesced', entry)
+                return self._consume_payload(entry[0], consume)
+            # Otherwise go round again: if the worker running the query
+            # gave up without caching a result (e.g. the query failed)
+            # then the lock will have been released and we'll take it.
+
+    def _fresh_cached_entry(self, key, policy):
+        entry = redis_get_entry(redis_api, key, policy)
+        if entry is None:
+            return None
+        _, fetched_at, _ = entry
+        if policy.is_stale(fetched_at):
+            return None
+        return entry
+
+    def _cached_entry(self, key, policy):
+        with self.prefetched_lock:
+            if key in self.prefetched:
+                return self.prefetched.pop(key)
+        return redis_get_entry(redis_api, key, policy)
+
+    def _consume_payload(self, payload, consume):
+        if consume is None:
+            return from_payload(payload)
+        return consume(iter_bindings(payload))
+
+    def _cached_run_query(self, wikidata_query, cache_policy='episodes', consume=None):
+        policy = CACHE_POLICIES[cache_policy]
+        normalized_query = normalize_query(wikidata_query.query)
+        key = query_cache_key(normalized_query)
+        # Purging the cache means wanting what's in Wikidata now, not
+        # as of the last dump:
+        if episode_store is not None and not self.purge_cache:
+            result = episode_store.answer(normalized_query)
+            if result is not None:
+                redis_incr(redis_api, 'stats:queries-local')
+                wikidata_query.outcome = 'local'
+                wikidata_query.rows = len(result['results']['bindings'])
+                if consume is None:
+                    return result
+                return consume(iter(result['results']['bindings']))
+        if self.purge_cache:
+            entry, consumed = self._fetch_and_cache(key, normalized_query, policy, consume, POST)
+            wikidata_query.record_entry('purged', entry)
+            return consumed
+        if self.refresh_cache:
+            entry, consumed = self._fetch_and_cache(key, normalized_query, policy, consume)
+            wikidata_query.record_entry('refreshed', entry)
+            return consumed
+        entry = self._cached_entry(key, policy)
+        if entry is None:
+            return self._coalesced_fetch(wikidata_query, key, normalized_query, policy, consume)
+        payload, fetched_at, _ = entry
+        if policy.is_stale(fetched_at):
+            if not STALE_WHILE_REVALIDATE:
+                return self._coalesced_fetch(wikidata_query, key, normalized_query, policy, consume)
+            # Serve the stale result now, and refresh it for next time
+            # (discarding the bindings, which only need to be cached):
+            redis_incr(redis_api, 'stats:queries-stale')
+            refresh_consume = None if consume is None else discard
+            schedule_refresh(
+                redis_api,
+                key,
+                lambda: self._fetch_and_cache(key, normalized_query, policy, refresh_consume)
+            )
+            wikidata_query.record_entry('stale', entry)
+        else:
+            wikidata_query.record_entry('hit', entry)
+        return self._consume_payload(payload, consume)
+
+    def _timed_run_query(self, wikidata_query, cache_policy='episodes', consume=None):
+        start = time.time()
+        try:
+            return self._cached_run_query(wikidata_query, cache_policy, consume)
+        except Exception:
+            wikidata_query.outcome = 'error'
+            raise
+        finally:
+            wikidata_query.seconds = time.time() - start
+            record_query(wikidata_query)
+
+    def prefetch(self, queries, cache_policy='episodes'):
+        '''Look up the cached results of queries that are about to be run, all at once
+
+        Rather than each query that's run later on needing its own
+        round trip to Redis, the cache entries for all of them are
+        fetched together with a single MGET, and used (once) when
+        they're run. Nothing is prefetched when purging or refreshing
+        the cache, since the cached results wouldn't be used.'''
+        if self.purge_cache or self.refresh_cache:
+            return
+        entries = redis_get_entries(
+            redis_api, [query_cache_key(query) for query in queries], CACHE_POLICIES[cache_policy])
+        with self.prefetched_lock:
+            self.prefetched.update(entries)
+
+    def run_query(self, query, why=None, cache_policy='episodes', consume=None):
+        '''Run query, using the cached result if there is one
+
+        cache_policy is the name of one of the cache.CACHE_POLICIES,
+        which determine how long results are used for.
+
+        If consume is given, query must be a SELECT query, and instead
+        of returning the whole result this returns what consume returns
+        when passed an iterator over the result's bindings. Those are
+        produced one at a time, whether they're coming from the cache
+        or streamed from the Wikidata Query Service, so consume can
+        process long results without them all being in memory.'''
+        wikidata_query = WikidataQuery(query, why)
+        self.queries.append(wikidata_query)
+        return self._timed_run_query(wikidata_query, cache_policy, consume)
+
+    def submit_query(self, query, why=None, cache_policy='episodes', consume=None):
+        '''Start running query in the background, returning a Future for its result
+
+        The arguments are as for run_query. The query is added to
+        self.queries straight away, so the log is in the order that
+        queries were submitted, not completed.
+
+        Each query gets its own thread (a greenlet with gevent
+        workers), rather than one from a pool shared with other
+        requests, so a query that's served from the cache never waits
+        behind slow ones; QUERY_CONCURRENCY limits only the requests
+        to the query service.'''
+        wikidata_query = WikidataQuery(query, why)
+        self.queries.append(wikidata_query)
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self._timed_run_query(wikidata_query, cache_policy, consume))
+            except BaseException as e:
+                future.set_exception(e)
+
+        thread = Thread(target=run, name='wikidata-query')
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def run_queries(self, queries_with_reasons, cache_policy='episodes'):
+        '''Run independent queries concurrently, returning their results in order
+
+        queries_with_reasons should be a sequence of (query, why) or
+        (query, why, consume) tuples; see run_query for consume.'''
+        queries_with_reasons = list(queries_with_reasons)
+        if not queries_with_reasons:
+            return []
+        arguments = [
+            (query_and_reason[0], query_and_reason[1], cache_policy,
+             query_and_reason[2] if len(query_and_reason) > 2 else None)
+            for query_and_reason in queries_with_reasons
+        ]
+        # The last query runs on this thread while the others run on
+        # their own:
+        futures = [self.submit_query(*a) for a in arguments[:-1]]
+        last_result = self.run_query(*arguments[-1])
+        return [future.result() for future in futures] + [last_result]